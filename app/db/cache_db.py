@@ -0,0 +1,51 @@
+"""Database queries used by med-ai runner"""
+
+from sqlalchemy import text
+from utils import db_utils
+from utils.db_utils import DBConn
+
+CACHE_CHANNEL = 'runner_cache'
+CACHED_TABLES = ['model', 'eval_job']
+
+def install_change_triggers():
+    """
+    Makes changes to the cached tables notify the cache channel with the table name.
+    Run by migrate.py, it takes an advisory lock so concurrent deploys do not race
+    and only creates the triggers that are missing
+    """
+    with DBConn() as session:
+        session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:channel))"), {'channel': CACHE_CHANNEL})
+        session.execute(text(f'''
+        CREATE OR REPLACE FUNCTION runner_notify_cache() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CACHE_CHANNEL}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        '''))
+        for table in CACHED_TABLES:
+            trigger = f'runner_notify_cache_{table}'
+            exists = session.execute(text("SELECT 1 FROM pg_trigger WHERE tgname = :trigger"),
+                                     {'trigger': trigger}).first()
+            if exists is None:
+                session.execute(text(f'''
+                CREATE TRIGGER {trigger}
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE PROCEDURE runner_notify_cache()
+                '''))
+
+def open_listener():
+    """
+    Opens a connection outside the pool that listens on the cache channel
+
+    Returns:
+        the psycopg2 connection, notifications are read with poll()
+    """
+    fairy = db_utils.db_engine.raw_connection()
+    # the connection is kept for the life of the process so it must not hold a pool slot
+    fairy.detach()
+    connection = fairy.connection
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f'LISTEN {CACHE_CHANNEL}')
+    return connection
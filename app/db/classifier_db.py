@@ -1,5 +1,6 @@
 """Database queries used by med-ai runner"""
 
+from sqlalchemy.orm import contains_eager
 from db.models import Classifier, Model, Study
 from utils.db_utils import DBConn
 
@@ -15,6 +16,7 @@ def get_classifier_model(modality: str) -> Classifier:
     """
     with DBConn() as session:
         classifier = session.query(Classifier).join(Model).\
+                                        options(contains_eager(Classifier.model)).\
                                         filter(Model.modality==modality).scalar()
     return classifier
 
@@ -1,9 +1,13 @@
 """Database queries used by med-ai runner"""
 
 import json
-from typing import List, Dict
+from typing import List, Dict, Tuple
+from sqlalchemy import Integer, cast, column, func, literal, text, update, values
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.orm import aliased, joinedload
 from utils.db_utils import DBConn
-from db.models import Classifier, EvalJob, Experiment, Model, Study, StudyEvaluation
+from db import experiment_db
+from db.models import Classifier, EvalJob, Model, Study, StudyEvaluation, t_experiment_studies_study
 
 from medaimodels import ModelOutput
 
@@ -16,20 +20,43 @@ def get_study_evals(eval_ids) -> List[StudyEvaluation]:
     return evals
 
 def add_stdout_to_eval(eval_ids: List[int], lines: List[str]):
+    """
+    Appends lines to the stdout of evaluations. The concatenation happens inside
+    postgres so the existing log is never read back and concurrent appends are not lost
+
+    Args:
+        eval_ids (List[int]): the db ids of the evaluations
+        lines (List[str]): the lines to append
+    """
     with DBConn() as session:
         print('evalids are ', eval_ids)
-        studies = get_study_evals(eval_ids)
+        session.query(StudyEvaluation).\
+                filter(StudyEvaluation.id.in_(eval_ids)).\
+                update({StudyEvaluation.stdout: append_jsonb(StudyEvaluation.stdout, cast(literal(lines, JSONB), JSONB))},
+                       synchronize_session=False)
+
+def append_stdout_bulk(lines_by_eval: Dict[int, List[str]]):
+    """
+    Appends lines to the stdout of many evaluations with one statement
 
-        stdout = []
+    Args:
+        lines_by_eval (Dict[int, List[str]]): the lines to append keyed by eval id
+    """
+    if len(lines_by_eval) == 0:
+        return
+
+    rows = values(column('id', Integer), column('lines', JSONB), name='logs').\
+                data(list(lines_by_eval.items()))
 
-        if studies[0].stdout is not None:
-            stdout = studies[0].stdout
+    statement = update(StudyEvaluation).\
+                    where(StudyEvaluation.id == rows.c.id).\
+                    values(stdout=append_jsonb(StudyEvaluation.stdout, cast(rows.c.lines, JSONB))).\
+                    execution_options(synchronize_session=False)
+    with DBConn() as session:
+        session.execute(statement)
 
-        stdout = stdout + lines
-        evaluations = session.query(StudyEvaluation).\
-                    filter(StudyEvaluation.id.in_(eval_ids)).all()
-        for e in evaluations:
-            e.stdout = stdout
+def append_jsonb(stdout, lines):
+    return func.coalesce(stdout, cast('[]', JSONB)).op('||')(lines)
 
 
 def get_default_model():
@@ -91,12 +118,11 @@ def get_failed_eval_ids_by_exp(experimentId: int) -> List[int]:
 
     with DBConn() as session:
 
-        evals: List[StudyEvaluation] = session.query(StudyEvaluation).\
-                                                join(Study).\
-                                                filter(Experiment.study.any(id=Study.id)).\
-                                                filter(StudyEvaluation.status == 'FAILED').\
-                                                filter(Experiment.id == experimentId).\
-                                                all()
+        evals = session.query(StudyEvaluation.id).\
+                        join(t_experiment_studies_study, t_experiment_studies_study.c.studyId == StudyEvaluation.studyId).\
+                        filter(t_experiment_studies_study.c.experimentId == experimentId).\
+                        filter(StudyEvaluation.status == 'FAILED').\
+                        all()
     return [e.id for e in evals]
 
 def fail_eval(eval_id: int):
@@ -116,7 +142,9 @@ def fail_eval(eval_id: int):
 
         evaulation = session.query(StudyEvaluation).filter(StudyEvaluation.id == eval_id).\
                                             scalar()
+        previous = evaulation.status
         evaulation.status = 'FAILED'
+    record_transitions([(eval_id, previous)], 'FAILED')
     return evaulation
 
 def get_eval_jobs() -> List[Dict]:
@@ -136,7 +164,7 @@ def get_eval_jobs() -> List[Dict]:
 
     with DBConn() as session:
 
-        eval_jobs = session.query(EvalJob).filter(EvalJob.running==True).all()
+        eval_jobs = session.query(EvalJob).options(joinedload(EvalJob.model)).filter(EvalJob.running==True).all()
     return eval_jobs
 
 def update_eval_status_and_save(output: ModelOutput, eval_id: int) -> StudyEvaluation:
@@ -157,33 +185,83 @@ def update_eval_status_and_save(output: ModelOutput, eval_id: int) -> StudyEvalu
 
         evaluation = session.query(StudyEvaluation).filter(StudyEvaluation.id == eval_id).\
                                             scalar()
+        previous = evaluation.status
         evaluation.status = 'COMPLETED'
         evaluation.modelOutput = output
         evaluation.finishTime = int(time.time())
         evaluation.imgOutputPath = output['image'] if output and output['image'] else None
+    record_transitions([(eval_id, previous)], 'COMPLETED')
     return evaluation
 
-def restart_failed_evals(eval_ids: List[int]):
+def complete_evals(results: List[Tuple[int, ModelOutput]]):
     """
-    sets a failed evaluation to status 'RUNNING' to restart it
+    Sets many evaluations to completed and saves their outputs with a single
+    UPDATE ... FROM (VALUES ...) statement
 
     Args:
-        eval_ids (List[int]): a list of the ids of evals to be restarted
+        results (List[Tuple[int, ModelOutput]]): pairs of eval id and model output
     """
-
+    if len(results) == 0:
+        return
+
+    rows = values(column('id', Integer), column('output', JSONB), column('image'), name='results').\
+                data([(eval_id, output, output.get('image') if output else None) for eval_id, output in results])
+
+    # joining the table again exposes the status from before the update
+    previous = aliased(StudyEvaluation)
+    statement = update(StudyEvaluation).\
+                    where(StudyEvaluation.id == rows.c.id).\
+                    where(previous.id == StudyEvaluation.id).\
+                    values(status='COMPLETED',
+                           modelOutput=cast(rows.c.output, JSONB),
+                           imgOutputPath=rows.c.image,
+                           finishTime=int(time.time())).\
+                    returning(StudyEvaluation.id, previous.status).\
+                    execution_options(synchronize_session=False)
     with DBConn() as session:
-        if len(eval_ids) == 0:
-            return
+        transitions = session.execute(statement).all()
+    record_transitions(transitions, 'COMPLETED')
 
-        # sql = f'''
-        # UPDATE study_evaluation
-        # SET status='RUNNING'
-        # WHERE id in ({ids})
-        # '''
-        evaluation = session.query(StudyEvaluation).filter(StudyEvaluation.id.in_(eval_ids)).scalar()
+def record_transitions(transitions: List[Tuple[int, str]], status: str):
+    """
+    Updates the progress counters of experiments for evaluations that changed status
 
-        evaluation.status = 'QUEUED'
+    Args:
+        transitions (List[Tuple[int, str]]): pairs of eval id and its previous status
+        status (str): the status the evaluations were set to
+    """
+    changes = [(eval_id, int(status == 'COMPLETED') - int(previous == 'COMPLETED'),
+                int(status == 'FAILED') - int(previous == 'FAILED'))
+               for eval_id, previous in transitions]
+    changes = [change for change in changes if change[1] or change[2]]
+    if len(changes) == 0:
+        return
+    eval_ids, completed, failed = zip(*changes)
+    experiment_db.record_eval_outcomes(eval_ids, completed, failed)
+
+def restart_failed_evals(eval_ids: List[int]) -> List[int]:
+    """
+    sets failed evaluations to status 'QUEUED' to restart them
 
+    Args:
+        eval_ids (List[int]): a list of the ids of evals to be restarted
+
+    Returns:
+        List[int]: the ids of the evals that were restarted
+    """
+    if len(eval_ids) == 0:
+        return []
+
+    statement = update(StudyEvaluation).\
+                    where(StudyEvaluation.id.in_(eval_ids)).\
+                    where(StudyEvaluation.status == 'FAILED').\
+                    values(status='QUEUED').\
+                    returning(StudyEvaluation.id).\
+                    execution_options(synchronize_session=False)
+    with DBConn() as session:
+        restarted = session.execute(statement).all()
+    record_transitions([(r.id, 'FAILED') for r in restarted], 'QUEUED')
+    return [r.id for r in restarted]
 
 def start_study_evaluations(studies: List[Study], model_id: int) -> List[int]:
     """
@@ -196,34 +274,42 @@ def start_study_evaluations(studies: List[Study], model_id: int) -> List[int]:
     Returns:
         List[int]: a list of ids of the db entries that were inserted
     """
+    _, eval_ids = create_evaluations(studies, model_id)
+    return eval_ids
 
-    with DBConn() as session:             
-        logger_service.log(f'starting study evaluations for {studies}')
-
-        for study in studies:
-            messaging_service.send_notification(f"Started evaluation of study {study.orthancStudyId}", 'eval_started', -1)
-
-        if len(studies) == 0:
-            return []
-
-        # # query and fetch all results
-        # sql = f'''
-        # INSERT INTO study_evaluation ("studyId", "modelOutput", status, "modelId")
-        # VALUES {reduced}
-        # RETURNING id;
-        # '''
-        model:Model = session.query(Model).filter(Model.id==model_id).scalar()
-        evals_to_add = [StudyEvaluation(studyId=study.id,
-                                        modelOutput=None,
-                                        status='QUEUED',
-                                        modelId=model_id) for study in studies]
-        session.add_all(evals_to_add)
-        study_ids = [study.id for study in studies]
-        evals: List[StudyEvaluation] = session.query(StudyEvaluation).\
-                                                    filter(StudyEvaluation.studyId.in_(study_ids)).\
-                                                    all()
+def create_evaluations(studies: List[Study], model_id: int) -> Tuple[List[Study], List[int]]:
+    """
+    inserts 'QUEUED' entries into the study_evaluation table with a single
+    INSERT ... ON CONFLICT DO NOTHING RETURNING. Studies that already have an
+    evaluation for the model are skipped instead of failing the batch
 
-    return [e.id for e in evals]
+    Args:
+        studies (List[Study]): the studies to evaluate
+        model_id (int): the id of the model to use in evalution
+
+    Returns:
+        Tuple[List[Study], List[int]]: the studies that got a new evaluation and the new eval ids in the same order
+    """
+    logger_service.log(f'starting study evaluations for {studies}')
+
+    if len(studies) == 0:
+        return [], []
+
+    statement = insert(StudyEvaluation).\
+                    values([{'studyId': study.id, 'status': 'QUEUED', 'modelId': model_id} for study in studies]).\
+                    on_conflict_do_nothing(index_elements=[StudyEvaluation.modelId, StudyEvaluation.studyId]).\
+                    returning(StudyEvaluation.id, StudyEvaluation.studyId)
+    with DBConn() as session:
+        inserted = session.execute(statement).all()
+        model_name = session.query(Model.displayName).filter(Model.id==model_id).scalar()
+
+    eval_ids_by_study = {row.studyId: row.id for row in inserted}
+    created = [study for study in studies if study.id in eval_ids_by_study]
+
+    # notify once the evaluations are committed
+    messaging_service.send_notifications([f"Started evaluation of study {study.orthancStudyId}" for study in created],
+                                         'eval_started', -1, group=f'model {model_name}')
+    return created, [eval_ids_by_study[study.id] for study in created]
 
 def set_eval_running(eval_id: int):
     with DBConn() as session:
@@ -231,4 +317,44 @@ def set_eval_running(eval_id: int):
                                             scalar()
         evaluation.status = 'RUNNING'
         evaluation.startTime = int(time.time()) 
-    return evaluation
\ No newline at end of file
+    return evaluation
+
+def claim_studies(model_id: int, batch_size: int) -> Tuple[List[Study], List[int]]:
+    """
+    Dequeues the next pending studies of a model and inserts 'QUEUED' evaluations
+    for them in one statement. Queue rows being claimed by another worker are skipped
+    so any number of workers can claim work for the same model without duplicates.
+    The cost depends on the batch size, not on the number of studies in the archive
+
+    Args:
+        model_id (int): the id of the model to use in evalution
+        batch_size (int): the maximum number of studies to claim
+
+    Returns:
+        Tuple[List[Study], List[int]]: the claimed studies and their new eval ids in the same order
+    """
+    sql = text('''
+    WITH claimed AS (
+        DELETE FROM pending_evaluation pe
+        WHERE (pe."modelId", pe."studyId") IN (
+            SELECT p."modelId", p."studyId" FROM pending_evaluation p
+            WHERE p."modelId" = :model_id
+            ORDER BY p."enqueuedAt", p."studyId"
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING pe."studyId"
+    )
+    INSERT INTO study_evaluation ("studyId", "modelId", status)
+    SELECT claimed."studyId", :model_id, 'QUEUED' FROM claimed
+    ON CONFLICT ("modelId", "studyId") DO NOTHING
+    RETURNING id, "studyId"
+    ''')
+    with DBConn() as session:
+        claimed = session.execute(sql, {'model_id': model_id, 'batch_size': batch_size}).all()
+        if len(claimed) == 0:
+            return [], []
+        studies = session.query(Study).filter(Study.id.in_([c.studyId for c in claimed])).all()
+
+    studies_by_id = {study.id: study for study in studies}
+    return [studies_by_id[c.studyId] for c in claimed], [c.id for c in claimed]
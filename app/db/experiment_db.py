@@ -1,23 +1,47 @@
 """Database queries used by med-ai runner"""
-from db.models import Experiment, Study, StudyEvaluation
+import time
+from typing import Dict, List
+from sqlalchemy import and_, select, text
+from db.models import Experiment, ExperimentProgress, Study, StudyEvaluation, t_experiment_studies_study
 from utils.db_utils import DBConn
 
-def get_studies_for_experiment(experiment_id):
+def get_experiment_study_ids(experiment_id):
     """
+    Selects the ids of an experiment's studies from the association table so the
+    studies are not loaded just to read their ids
+    """
+    return select(t_experiment_studies_study.c.studyId).\
+                where(t_experiment_studies_study.c.experimentId == experiment_id)
+
+def get_studies_for_experiment(experiment_id, limit: int = None):
+    """
+    Gets the studies of an experiment that the experiment's model has not evaluated
+
+    Args:
+        experiment_id (int): the db id of the experiment
+        limit (int): the maximum number of studies to return
+
+    Returns:
+        List[Study]: the unevaluated studies
     """
     # sql = f'''
-    # SELECT  distinct s.* FROM study s
-    # LEFT JOIN study_evaluation se on s.id = se."studyId"
+    # SELECT s.* FROM study s
     # INNER JOIN experiment_studies_study es on s.id = es."studyId"
-    # WHERE se.id is null
+    # INNER JOIN experiment e on e.id = es."experimentId"
+    # LEFT JOIN study_evaluation se on s.id = se."studyId" and se."modelId" = e."modelId"
+    # WHERE es."experimentId" = {experiment_id} and se.id is null
     # '''
     with DBConn() as session:
-        experiment_study_ids = [s.id for s in session.query(Experiment).filter(Experiment.id == experiment_id).scalar().study]
-        
         studies = session.query(Study).\
-                            filter(Study.id.in_(experiment_study_ids)).\
-                            outerjoin(StudyEvaluation).\
-                            filter(StudyEvaluation.id == None).distinct().all()
+                            join(t_experiment_studies_study, t_experiment_studies_study.c.studyId == Study.id).\
+                            join(Experiment, Experiment.id == t_experiment_studies_study.c.experimentId).\
+                            outerjoin(StudyEvaluation, and_(StudyEvaluation.studyId == Study.id,
+                                                            StudyEvaluation.modelId == Experiment.modelId)).\
+                            filter(t_experiment_studies_study.c.experimentId == experiment_id).\
+                            filter(StudyEvaluation.id == None).\
+                            order_by(Study.id).\
+                            limit(limit).\
+                            all()
 
     return studies
 
@@ -33,10 +57,8 @@ def get_running_studies_for_experiment(experiment_id):
     # '''
 
     with DBConn() as session:
-        experiment_study_ids = [s.id for s in session.query(Experiment).filter(Experiment.id == experiment_id).scalar().study]
-        
         studies = session.query(Study).\
-                            filter(Study.id.in_(experiment_study_ids)).\
+                            filter(Study.id.in_(get_experiment_study_ids(experiment_id))).\
                             join(StudyEvaluation).\
                             filter(StudyEvaluation.status == 'QUEUED').distinct().all()
 
@@ -81,3 +103,107 @@ def set_experiment_failed(experiment_id):
         exp = session.query(Experiment).filter(Experiment.id == experiment_id).scalar()
         exp.status = 'STOPPED'
 
+
+def seed_progress(experiment_ids: List[int]) -> Dict[int, ExperimentProgress]:
+    """
+    Counts the studies of each experiment by the status of the experiment model's
+    evaluation with one aggregate query and saves the counts as the progress counters
+
+    Args:
+        experiment_ids (List[int]): the db ids of the experiments
+
+    Returns:
+        Dict[int, ExperimentProgress]: the progress keyed by experiment id, experiments
+            without studies are missing
+    """
+    if len(experiment_ids) == 0:
+        return {}
+
+    sql = text('''
+    INSERT INTO experiment_progress ("experimentId", total, started, completed, failed, "seededAt")
+    SELECT es."experimentId",
+           count(*),
+           count(se.id),
+           count(*) FILTER (WHERE se.status = 'COMPLETED'),
+           count(*) FILTER (WHERE se.status = 'FAILED'),
+           :now
+    FROM experiment_studies_study es
+    INNER JOIN experiment e ON e.id = es."experimentId"
+    LEFT JOIN study_evaluation se ON se."studyId" = es."studyId" AND se."modelId" = e."modelId"
+    WHERE es."experimentId" = ANY(:experiment_ids)
+    GROUP BY es."experimentId"
+    ON CONFLICT ("experimentId") DO UPDATE SET
+        total = excluded.total,
+        started = excluded.started,
+        completed = excluded.completed,
+        failed = excluded.failed,
+        "seededAt" = excluded."seededAt"
+    RETURNING "experimentId", total, started, completed, failed, "seededAt"
+    ''')
+    with DBConn() as session:
+        rows = session.execute(sql, {'now': int(time.time()), 'experiment_ids': list(experiment_ids)}).all()
+
+    return {row.experimentId: row for row in rows}
+
+def get_progress(experiment_ids: List[int]) -> Dict[int, ExperimentProgress]:
+    """
+    Gets the progress counters of experiments
+
+    Args:
+        experiment_ids (List[int]): the db ids of the experiments
+
+    Returns:
+        Dict[int, ExperimentProgress]: the progress keyed by experiment id, experiments
+            that were never seeded are missing
+    """
+    if len(experiment_ids) == 0:
+        return {}
+
+    with DBConn() as session:
+        rows = session.query(ExperimentProgress.experimentId, ExperimentProgress.total,
+                             ExperimentProgress.started, ExperimentProgress.completed,
+                             ExperimentProgress.failed, ExperimentProgress.seededAt).\
+                        filter(ExperimentProgress.experimentId.in_(experiment_ids)).\
+                        all()
+
+    return {row.experimentId: row for row in rows}
+
+def add_started(experiment_id: int, count: int):
+    """
+    Counts evaluations created for an experiment
+    """
+    with DBConn() as session:
+        session.query(ExperimentProgress).\
+                filter(ExperimentProgress.experimentId == experiment_id).\
+                update({ExperimentProgress.started: ExperimentProgress.started + count},
+                       synchronize_session=False)
+
+def record_eval_outcomes(eval_ids: List[int], completed: List[int], failed: List[int]):
+    """
+    Adds the change in completed and failed evaluations to the progress of every
+    experiment that contains the evaluations' studies for the evaluations' model
+
+    Args:
+        eval_ids (List[int]): the db ids of the evaluations that changed status
+        completed (List[int]): the change in completed count of each evaluation
+        failed (List[int]): the change in failed count of each evaluation
+    """
+    if len(eval_ids) == 0:
+        return
+
+    sql = text('''
+    UPDATE experiment_progress ep
+    SET completed = ep.completed + d.completed, failed = ep.failed + d.failed
+    FROM (
+        SELECT es."experimentId" AS id, sum(c.completed) AS completed, sum(c.failed) AS failed
+        FROM unnest(CAST(:eval_ids AS integer[]), CAST(:completed AS integer[]), CAST(:failed AS integer[]))
+            AS c(eval_id, completed, failed)
+        INNER JOIN study_evaluation se ON se.id = c.eval_id
+        INNER JOIN experiment_studies_study es ON es."studyId" = se."studyId"
+        INNER JOIN experiment e ON e.id = es."experimentId" AND e."modelId" = se."modelId"
+        GROUP BY es."experimentId"
+    ) d
+    WHERE ep."experimentId" = d.id
+    ''')
+    with DBConn() as session:
+        session.execute(sql, {'eval_ids': list(eval_ids), 'completed': list(completed), 'failed': list(failed)})
@@ -2,6 +2,7 @@
 
 import json
 from typing import Dict, List
+from sqlalchemy.orm import joinedload
 from db.models import EvalJob, Model
 from utils.db_utils import DBConn
 
@@ -40,7 +41,7 @@ def get_jobs_to_quickstart() -> List[Model]:
     # where running=false and "quickStart"=true
     # '''
     with DBConn() as session:
-        jobs = session.query(EvalJob).all()
+        jobs = session.query(EvalJob).options(joinedload(EvalJob.model)).all()
 
     return jobs
 
@@ -64,7 +65,7 @@ def stop_all_models():
     
 def get_job_by_model(model_id: int):
     with DBConn() as session:
-        job = session.query(EvalJob).filter(EvalJob.modelId==model_id).scalar()
+        job = session.query(EvalJob).options(joinedload(EvalJob.model)).filter(EvalJob.modelId==model_id).scalar()
     return job
 
 def mark_model_as_stopped(model_id):
@@ -82,3 +83,17 @@ def mark_model_as_stopped(model_id):
     # '''
     with DBConn() as session:
         model = session.query(Model).filter(Model.id==model_id)
+
+def get_routing_models() -> List:
+    """
+    selects the input criteria of every model with a running eval job
+
+    Returns:
+        List: rows of (id, modality, input, inputType)
+    """
+    with DBConn() as session:
+        models = session.query(Model.id, Model.modality, Model.input, Model.inputType).\
+                        join(EvalJob, EvalJob.modelId == Model.id).\
+                        filter(EvalJob.running == True).\
+                        all()
+    return models
@@ -1,5 +1,5 @@
 # coding: utf-8
-from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Integer, String, Table, Text, UniqueConstraint, text
+from sqlalchemy import BigInteger, Boolean, Column, Float, ForeignKey, Index, Integer, String, Table, Text, UniqueConstraint, text
 from sqlalchemy.dialects.postgresql import JSONB, TIMESTAMP
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -198,3 +198,105 @@ t_experiment_studies_study = Table(
     Column('experimentId', ForeignKey('experiment.id', ondelete='CASCADE'), primary_key=True, nullable=False, index=True),
     Column('studyId', ForeignKey('study.id', ondelete='CASCADE'), primary_key=True, nullable=False, index=True)
 )
+
+
+class OrthancCursor(Base):
+    __tablename__ = 'orthanc_cursor'
+
+    name = Column(String, primary_key=True)
+    seq = Column(BigInteger, nullable=False, server_default=text("0"))
+
+
+class StagedSeries(Base):
+    __tablename__ = 'staged_series'
+
+    orthancId = Column(String, primary_key=True)
+    instancesHash = Column(String)
+    bytes = Column(BigInteger, nullable=False, server_default=text("0"))
+    refCount = Column(Integer, nullable=False, server_default=text("0"))
+    lastAccess = Column(BigInteger, nullable=False)
+    downloadSeconds = Column(Float)
+    prefetched = Column(Boolean, nullable=False, server_default=text("false"))
+
+
+class StagingLease(Base):
+    __tablename__ = 'staging_lease'
+
+    orthancId = Column(String, primary_key=True)
+    instancesHash = Column(String, nullable=False)
+    owner = Column(String, nullable=False)
+    expiresAt = Column(BigInteger, nullable=False)
+
+
+class PendingEvaluation(Base):
+    __tablename__ = 'pending_evaluation'
+
+    modelId = Column(ForeignKey('model.id', ondelete='CASCADE'), primary_key=True)
+    studyId = Column(ForeignKey('study.id', ondelete='CASCADE'), primary_key=True)
+    enqueuedAt = Column(BigInteger, nullable=False)
+
+
+class PendingBackfill(Base):
+    __tablename__ = 'pending_backfill'
+
+    modelId = Column(ForeignKey('model.id', ondelete='CASCADE'), primary_key=True)
+    backfilledAt = Column(BigInteger, nullable=False)
+
+
+class ExperimentProgress(Base):
+    __tablename__ = 'experiment_progress'
+
+    experimentId = Column(ForeignKey('experiment.id', ondelete='CASCADE'), primary_key=True)
+    total = Column(Integer, nullable=False, server_default=text("0"))
+    started = Column(Integer, nullable=False, server_default=text("0"))
+    completed = Column(Integer, nullable=False, server_default=text("0"))
+    failed = Column(Integer, nullable=False, server_default=text("0"))
+    seededAt = Column(BigInteger, nullable=False)
+
+
+class BackfillProgress(Base):
+    __tablename__ = 'backfill_progress'
+
+    modelId = Column(ForeignKey('model.id', ondelete='CASCADE'), primary_key=True)
+    token = Column(String, nullable=False)
+    lastStudyId = Column(Integer, nullable=False, server_default=text("0"))
+    updatedAt = Column(BigInteger, nullable=False)
+
+
+class RouteSignature(Base):
+    __tablename__ = 'route_signature'
+
+    modelId = Column(ForeignKey('model.id', ondelete='CASCADE'), primary_key=True)
+    signature = Column(String, nullable=False)
+
+
+# tables owned by the runner rather than the med-ai backend migrations.
+# these are created on startup if they do not exist yet
+RUNNER_TABLES = [
+    OrthancCursor.__table__,
+    StagedSeries.__table__,
+    StagingLease.__table__,
+    PendingEvaluation.__table__,
+    PendingBackfill.__table__,
+    BackfillProgress.__table__,
+    RouteSignature.__table__,
+    ExperimentProgress.__table__,
+]
+
+# indexes for the runner's hot queries. the backend migrations do not declare them so
+# migrate.py creates them, including on backend owned tables, if they are missing
+RUNNER_INDEXES = [
+    Index('ix_study_evaluation_model_status', StudyEvaluation.modelId, StudyEvaluation.status),
+    Index('ix_study_evaluation_study', StudyEvaluation.studyId),
+    Index('ix_study_evaluation_failed', StudyEvaluation.modelId,
+          postgresql_where=StudyEvaluation.status == 'FAILED'),
+    Index('ix_study_evaluation_running', StudyEvaluation.modelId,
+          postgresql_where=StudyEvaluation.status.in_(['QUEUED', 'RUNNING'])),
+    Index('ix_study_modality', Study.modality),
+    Index('ix_study_deleted_date_added', Study.deletedFromOrthanc, Study.dateAdded),
+    Index('ix_study_orthanc_parent', Study.orthancParentId),
+    Index('ix_eval_job_running', EvalJob.running, postgresql_where=EvalJob.running == True),
+    Index('ix_pending_evaluation_claim', PendingEvaluation.modelId, PendingEvaluation.enqueuedAt,
+          PendingEvaluation.studyId),
+    Index('ix_staged_series_last_access', StagedSeries.lastAccess),
+]
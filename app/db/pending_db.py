@@ -0,0 +1,197 @@
+"""Database queries used by med-ai runner"""
+
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from utils.db_utils import DBConn
+from db.models import BackfillProgress, PendingBackfill, PendingEvaluation, RouteSignature, Study
+
+def enqueue_routes(routes: List[Tuple[int, str]]):
+    """
+    Queues routed studies for the models that take them, skipping studies the model
+    already evaluated
+
+    Args:
+        routes (List[Tuple[int, str]]): pairs of (model id, orthanc id)
+    """
+    if len(routes) == 0:
+        return
+
+    sql = text('''
+    INSERT INTO pending_evaluation ("modelId", "studyId", "enqueuedAt")
+    SELECT r.model_id, s.id, :now
+    FROM unnest(CAST(:model_ids AS integer[]), CAST(:orthanc_ids AS varchar[])) AS r(model_id, orthanc_id)
+    INNER JOIN study s ON s."orthancStudyId" = r.orthanc_id
+    WHERE NOT EXISTS (
+        SELECT 1 FROM study_evaluation se
+        WHERE se."studyId" = s.id AND se."modelId" = r.model_id
+    )
+    ON CONFLICT DO NOTHING
+    ''')
+    with DBConn() as session:
+        session.execute(sql, {
+            'now': int(time.time()),
+            'model_ids': [model_id for model_id, _ in routes],
+            'orthanc_ids': [orthanc_id for _, orthanc_id in routes]
+        })
+
+def remove_stopped(running_model_ids: List[int]) -> Set[int]:
+    """
+    Drops the queue of jobs that were stopped so enabling them again backfills again
+
+    Args:
+        running_model_ids (List[int]): the model ids of the running eval jobs
+
+    Returns:
+        Set[int]: the model ids of the running jobs that were already backfilled
+    """
+    with DBConn() as session:
+        stopped = session.query(PendingBackfill.modelId).\
+                        filter(PendingBackfill.modelId.notin_(running_model_ids)).\
+                        all()
+        stopped_ids = [s.modelId for s in stopped]
+        session.query(BackfillProgress).\
+                filter(BackfillProgress.modelId.notin_(running_model_ids)).\
+                delete(synchronize_session=False)
+        if len(stopped_ids) > 0:
+            session.query(PendingEvaluation).\
+                    filter(PendingEvaluation.modelId.in_(stopped_ids)).\
+                    delete(synchronize_session=False)
+            session.query(PendingBackfill).\
+                    filter(PendingBackfill.modelId.in_(stopped_ids)).\
+                    delete(synchronize_session=False)
+
+        backfilled = session.query(PendingBackfill.modelId).all()
+    return {b.modelId for b in backfilled}
+
+def save_route_signatures(signatures: Dict[int, str]) -> List[int]:
+    """
+    Saves the routing criteria signature of each model and finds the models whose
+    criteria changed since they were last saved
+
+    Args:
+        signatures (Dict[int, str]): the criteria signature keyed by model id
+
+    Returns:
+        List[int]: the ids of the models whose saved signature differs
+    """
+    if len(signatures) == 0:
+        return []
+
+    with DBConn() as session:
+        saved = session.query(RouteSignature.modelId, RouteSignature.signature).\
+                        filter(RouteSignature.modelId.in_(list(signatures))).\
+                        all()
+        changed = [s.modelId for s in saved if s.signature != signatures[s.modelId]]
+        statement = insert(RouteSignature).\
+                        values([{'modelId': model_id, 'signature': signature}
+                                for model_id, signature in signatures.items()])
+        session.execute(statement.on_conflict_do_update(index_elements=[RouteSignature.modelId],
+                                                        set_={'signature': statement.excluded.signature}))
+    return changed
+
+def reset_backfill(model_id: int):
+    """
+    Drops the queue, the backfill marker and any backfill in progress of a model so
+    every unevaluated study is routed again
+    """
+    with DBConn() as session:
+        session.query(PendingEvaluation).\
+                filter(PendingEvaluation.modelId == model_id).\
+                delete(synchronize_session=False)
+        session.query(PendingBackfill).\
+                filter(PendingBackfill.modelId == model_id).\
+                delete(synchronize_session=False)
+        session.query(BackfillProgress).\
+                filter(BackfillProgress.modelId == model_id).\
+                delete(synchronize_session=False)
+
+def start_backfill(model_id: int, token: str, stale_before: int) -> bool:
+    """
+    Claims the backfill of a model for the task chain identified by token. A backfill
+    that has not moved since stale_before is taken over and resumes where it stopped
+
+    Args:
+        model_id (int): the db id of the model
+        token (str): identifies the task chain running the backfill
+        stale_before (int): backfills last moved before this time are abandoned
+
+    Returns:
+        bool: whether the backfill was claimed
+    """
+    now = int(time.time())
+    statement = insert(BackfillProgress).values(modelId=model_id, token=token, lastStudyId=0, updatedAt=now)
+    statement = statement.on_conflict_do_update(index_elements=[BackfillProgress.modelId],
+                                                set_={'token': token, 'updatedAt': now},
+                                                where=BackfillProgress.updatedAt < stale_before).\
+                          returning(BackfillProgress.modelId)
+    with DBConn() as session:
+        claimed = session.execute(statement).first()
+    return claimed is not None
+
+def get_backfill_position(model_id: int, token: str) -> Optional[int]:
+    """
+    Gets the id of the last study a backfill routed
+
+    Returns:
+        int: the study id, None if the backfill was reset or taken over by another chain
+    """
+    with DBConn() as session:
+        progress = session.query(BackfillProgress.lastStudyId).\
+                        filter(BackfillProgress.modelId == model_id).\
+                        filter(BackfillProgress.token == token).\
+                        first()
+    return progress.lastStudyId if progress else None
+
+def advance_backfill(model_id: int, token: str, last_study_id: int) -> bool:
+    """
+    Saves the id of the last study a backfill routed
+
+    Returns:
+        bool: whether the backfill still belongs to the chain
+    """
+    with DBConn() as session:
+        updated = session.query(BackfillProgress).\
+                        filter(BackfillProgress.modelId == model_id).\
+                        filter(BackfillProgress.token == token).\
+                        update({BackfillProgress.lastStudyId: last_study_id,
+                                BackfillProgress.updatedAt: int(time.time())},
+                               synchronize_session=False)
+    return updated > 0
+
+def finish_backfill(model_id: int, token: str):
+    """
+    Records that every existing study was routed for a model
+    """
+    with DBConn() as session:
+        finished = session.query(BackfillProgress).\
+                        filter(BackfillProgress.modelId == model_id).\
+                        filter(BackfillProgress.token == token).\
+                        delete(synchronize_session=False)
+        if finished > 0:
+            session.execute(insert(PendingBackfill).
+                                values(modelId=model_id, backfilledAt=int(time.time())).
+                                on_conflict_do_nothing())
+
+def peek_studies(model_id: int, offset: int, limit: int) -> List[Study]:
+    """
+    Gets queued studies for a model without claiming them
+
+    Args:
+        model_id (int): the db id of the model
+        offset (int): the number of queued studies to skip
+        limit (int): the maximum number of studies to return
+
+    Returns:
+        List[Study]: the queued studies in the order they will be claimed
+    """
+    with DBConn() as session:
+        studies = session.query(Study).\
+                        join(PendingEvaluation, PendingEvaluation.studyId == Study.id).\
+                        filter(PendingEvaluation.modelId == model_id).\
+                        order_by(PendingEvaluation.enqueuedAt, PendingEvaluation.studyId).\
+                        offset(offset).\
+                        limit(limit).\
+                        all()
+    return studies
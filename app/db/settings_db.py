@@ -1,5 +1,7 @@
 """Database queries used by med-ai runner"""
 
+from datetime import datetime
+from sqlalchemy import func
 from db.models import AppSetting
 from utils.db_utils import DBConn
 
@@ -8,3 +10,12 @@ def get_settings() -> AppSetting:
         settings = session.query(AppSetting).scalar()
 
     return settings
+
+def get_last_update() -> datetime:
+    """
+    Gets the time the app settings were last changed, used to detect changes cheaply
+    """
+    with DBConn() as session:
+        last_update = session.query(func.max(AppSetting.lastUpdate)).scalar()
+
+    return last_update
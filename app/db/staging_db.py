@@ -0,0 +1,193 @@
+"""Database queries used by med-ai runner"""
+
+import time
+from collections import Counter, defaultdict
+from typing import Callable, List
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+from utils.db_utils import DBConn
+from db.models import StagedSeries, StagingLease
+
+def add_reference(orthanc_id: str, references: int = 1):
+    """
+    Takes a reference on a staged series, creating the cache entry if needed
+
+    Args:
+        orthanc_id (str): the orthanc series id
+        references (int): the number of references to take. 0 only marks the series as used
+
+    Returns:
+        Row: the instancesHash, downloadSeconds and prefetched values of the entry.
+        instancesHash is None if nothing is staged yet
+    """
+    now = int(time.time())
+    statement = insert(StagedSeries).\
+                    values(orthancId=orthanc_id, refCount=references, lastAccess=now).\
+                    on_conflict_do_update(index_elements=[StagedSeries.orthancId],
+                                          set_={'refCount': StagedSeries.refCount + references,
+                                                'lastAccess': now}).\
+                    returning(StagedSeries.instancesHash,
+                              StagedSeries.downloadSeconds,
+                              StagedSeries.prefetched)
+    with DBConn() as session:
+        entry = session.execute(statement).first()
+    return entry
+
+def release_references(orthanc_ids: List[str]):
+    """
+    Drops a reference on each of the staged series. A series listed more than once
+    drops one reference per listing
+
+    Args:
+        orthanc_ids (List[str]): the orthanc series ids
+    """
+    if len(orthanc_ids) == 0:
+        return
+
+    # group the series by how many references they drop so each group is one update
+    by_count = defaultdict(list)
+    for orthanc_id, count in Counter(orthanc_ids).items():
+        by_count[count].append(orthanc_id)
+
+    with DBConn() as session:
+        for count, ids in by_count.items():
+            session.query(StagedSeries).\
+                    filter(StagedSeries.orthancId.in_(ids)).\
+                    update({StagedSeries.refCount: func.greatest(StagedSeries.refCount - count, 0),
+                            StagedSeries.lastAccess: int(time.time())},
+                           synchronize_session=False)
+
+def get_staged(orthanc_id: str):
+    """
+    Gets the staged state of a series
+
+    Returns:
+        Row: the instancesHash, downloadSeconds and prefetched values of the entry or
+        None if there is no entry
+    """
+    with DBConn() as session:
+        entry = session.query(StagedSeries.instancesHash,
+                              StagedSeries.downloadSeconds,
+                              StagedSeries.prefetched).\
+                        filter(StagedSeries.orthancId == orthanc_id).\
+                        first()
+    return entry
+
+def take_lease(orthanc_id: str, instances_hash: str, owner: str, timeout: int) -> bool:
+    """
+    Takes the lease to download a series. Only one worker holds the lease of a series
+    at a time, a lease that was not released before it expired can be taken over
+
+    Args:
+        orthanc_id (str): the orthanc series id
+        instances_hash (str): hash of the instances that will be downloaded
+        owner (str): identifies the download holding the lease
+        timeout (int): seconds until the lease expires
+
+    Returns:
+        bool: whether the lease was taken
+    """
+    now = int(time.time())
+    statement = insert(StagingLease).\
+                    values(orthancId=orthanc_id, instancesHash=instances_hash,
+                           owner=owner, expiresAt=now + timeout)
+    statement = statement.on_conflict_do_update(index_elements=[StagingLease.orthancId],
+                                                set_={'instancesHash': statement.excluded.instancesHash,
+                                                      'owner': statement.excluded.owner,
+                                                      'expiresAt': statement.excluded.expiresAt},
+                                                where=StagingLease.expiresAt < now).\
+                    returning(StagingLease.owner)
+    with DBConn() as session:
+        taken = session.execute(statement).first()
+    return taken is not None
+
+def has_lease(orthanc_id: str) -> bool:
+    """
+    Checks whether a download of the series is in progress
+    """
+    with DBConn() as session:
+        lease = session.query(StagingLease.owner).\
+                        filter(StagingLease.orthancId == orthanc_id).\
+                        filter(StagingLease.expiresAt >= int(time.time())).\
+                        first()
+    return lease is not None
+
+def release_lease(orthanc_id: str, owner: str):
+    with DBConn() as session:
+        session.query(StagingLease).\
+                filter(StagingLease.orthancId == orthanc_id).\
+                filter(StagingLease.owner == owner).\
+                delete(synchronize_session=False)
+
+def save_staged(orthanc_id: str, instances_hash: str, size: int, download_seconds: float, prefetched: bool):
+    """
+    Records that a series has been downloaded to the staging directory
+
+    Args:
+        orthanc_id (str): the orthanc series id
+        instances_hash (str): hash of the orthanc instance ids in the series
+        size (int): the number of bytes the series uses on disk
+        download_seconds (float): how long the download took
+        prefetched (bool): whether the series was downloaded ahead of an eval
+    """
+    with DBConn() as session:
+        session.query(StagedSeries).\
+                filter(StagedSeries.orthancId == orthanc_id).\
+                update({StagedSeries.instancesHash: instances_hash,
+                        StagedSeries.bytes: size,
+                        StagedSeries.downloadSeconds: download_seconds,
+                        StagedSeries.prefetched: prefetched},
+                       synchronize_session=False)
+
+def clear_prefetched(orthanc_id: str):
+    """
+    Marks a prefetched series as consumed so only the first eval counts it as saved time
+    """
+    with DBConn() as session:
+        session.query(StagedSeries).\
+                filter(StagedSeries.orthancId == orthanc_id).\
+                update({StagedSeries.prefetched: False}, synchronize_session=False)
+
+def evict_series(bytes_to_free: int, stale_before: int, remove: Callable[[str], None],
+                 batch_size: int = 20) -> List[str]:
+    """
+    Evicts least recently used series that no eval holds a reference on. Rows are
+    locked while their files are removed so a concurrent add_reference waits and
+    then sees the series as not staged. Series that are being downloaded are skipped.
+    Only batch_size rows are locked at a time and each batch is committed before the
+    next is locked, so evals of other series are not held up by a long eviction
+
+    Args:
+        bytes_to_free (int): stop once this many bytes have been evicted
+        stale_before (int): references last touched before this time are treated as leaked
+        remove (Callable[[str], None]): removes the files of a series from disk
+        batch_size (int): the number of rows locked per transaction
+
+    Returns:
+        List[str]: the orthanc ids of the evicted series
+    """
+    evicted = []
+    freed = 0
+    while freed < bytes_to_free:
+        with DBConn() as session:
+            batch: List[StagedSeries] = session.query(StagedSeries).\
+                                filter(or_(StagedSeries.refCount == 0,
+                                           StagedSeries.lastAccess < stale_before)).\
+                                filter(~session.query(StagingLease.orthancId).
+                                            filter(StagingLease.orthancId == StagedSeries.orthancId).
+                                            filter(StagingLease.expiresAt >= int(time.time())).
+                                            exists()).\
+                                order_by(StagedSeries.lastAccess).\
+                                limit(batch_size).\
+                                with_for_update(skip_locked=True).\
+                                all()
+            for series in batch:
+                if freed >= bytes_to_free:
+                    break
+                remove(series.orthancId)
+                freed += series.bytes or 0
+                evicted.append(series.orthancId)
+                session.delete(series)
+        if len(batch) < batch_size:
+            break
+    return evicted
@@ -1,13 +1,14 @@
 """Database queries used by med-ai runner"""
 
 import json
-from typing import List, Dict
+from typing import Dict, Iterator, List
 from utils.db_utils import DBConn
 from services.orthanc_service import OrthancMetadata
 from sqlalchemy import or_, and_, func
+from sqlalchemy.dialects.postgresql import insert
 
 from services import logger_service
-from db.models import Model, Study, StudyEvaluation
+from db.models import Model, OrthancCursor, Study, StudyEvaluation
 import time
 
 def get_study_by_orthanc_id(orthanc_id: str) -> Study:
@@ -46,6 +47,36 @@ def get_studies_for_model(model_id: int) ->List[Study]:
 
     return studies
 
+def get_unevaluated_studies(model_id: int, modality: str, after_id: int, limit: int) -> List:
+    """
+    Gets a page of the routing fields of studies of a modality that a model has not
+    evaluated, in id order so the next page starts after the last id of this one
+
+    Args:
+        model_id (int): the db id of the model
+        modality (str): the modality the model takes
+        after_id (int): the id of the last study of the previous page, 0 for the first
+        limit (int): the maximum number of studies to return
+
+    Returns:
+        List: rows of (id, orthancStudyId, modality, type, description, seriesMetadata, studyMetadata,
+            deletedFromOrthanc)
+    """
+    with DBConn() as session:
+        evaluated = session.query(StudyEvaluation.id).\
+                        filter(StudyEvaluation.studyId == Study.id).\
+                        filter(StudyEvaluation.modelId == model_id).\
+                        exists()
+        rows = session.query(Study.id, Study.orthancStudyId, Study.modality, Study.type, Study.description,
+                             Study.seriesMetadata, Study.studyMetadata, Study.deletedFromOrthanc).\
+                        filter(Study.modality == modality).\
+                        filter(Study.id > after_id).\
+                        filter(~evaluated).\
+                        order_by(Study.id).\
+                        limit(limit).\
+                        all()
+    return rows
+
 def remove_study_by_id(orthanc_id: str):
     """
     Removes a study from the db by its orthanc ID
@@ -80,6 +111,112 @@ def get_studies() -> List[Study]:
 
     return studies
 
+def iter_orthanc_ids(chunk_size: int = 10000) -> Iterator[str]:
+    """
+    Streams the orthanc id of every db study without loading the study rows
+
+    Args:
+        chunk_size (int): the number of ids fetched per round trip
+
+    Yields:
+        str: the orthanc id of a study
+    """
+    with DBConn() as session:
+        for row in session.query(Study.orthancStudyId).yield_per(chunk_size):
+            yield row.orthancStudyId
+
+def get_orthanc_ids() -> List[str]:
+    """
+    Gets the orthanc id of every db study without loading the study rows
+    """
+    return list(iter_orthanc_ids())
+
+def get_existing_orthanc_ids(orthanc_ids: List[str]) -> List[str]:
+    """
+    Gets the subset of the given orthanc ids that already have a study in the db
+
+    Args:
+        orthanc_ids (List[str]): the series ids from orthanc to check
+
+    Returns:
+        List[str]: the orthanc ids that are already saved
+    """
+    if len(orthanc_ids) == 0:
+        return []
+
+    with DBConn() as session:
+        rows = session.query(Study.orthancStudyId).\
+                        filter(Study.orthancStudyId.in_(orthanc_ids)).\
+                        all()
+    return [r.orthancStudyId for r in rows]
+
+def get_unclassified_studies(orthanc_ids: List[str]) -> List:
+    """
+    Gets the studies among the given orthanc ids that were claimed for ingestion but
+    are neither classified nor marked as failed yet
+
+    Args:
+        orthanc_ids (List[str]): the series ids from orthanc to check
+
+    Returns:
+        List: rows of (orthancStudyId, dateAdded)
+    """
+    if len(orthanc_ids) == 0:
+        return []
+
+    with DBConn() as session:
+        rows = session.query(Study.orthancStudyId, Study.dateAdded).\
+                        filter(Study.orthancStudyId.in_(orthanc_ids)).\
+                        filter(Study.type == None).\
+                        filter(Study.failed == False).\
+                        all()
+    return rows
+
+def fail_studies(orthanc_ids: List[str]):
+    """
+    Marks studies whose ingestion failed. They are kept so they are not ingested again
+
+    Args:
+        orthanc_ids (List[str]): the series ids from orthanc
+    """
+    if len(orthanc_ids) == 0:
+        return
+
+    with DBConn() as session:
+        session.query(Study).\
+                filter(Study.orthancStudyId.in_(orthanc_ids)).\
+                update({Study.failed: True}, synchronize_session=False)
+
+def get_orthanc_cursor(name: str) -> int:
+    """
+    Gets the last orthanc change sequence number that was ingested
+
+    Args:
+        name (str): the name of the cursor
+
+    Returns:
+        int: the saved sequence number or 0 if the cursor has never been saved
+    """
+    with DBConn() as session:
+        cursor = session.query(OrthancCursor).filter(OrthancCursor.name == name).scalar()
+        seq = cursor.seq if cursor else 0
+    return seq
+
+def save_orthanc_cursor(name: str, seq: int):
+    """
+    Saves the last orthanc change sequence number that was ingested
+
+    Args:
+        name (str): the name of the cursor
+        seq (int): the sequence number to resume from
+    """
+    # overlapping runs may finish out of order so the cursor only moves forward
+    statement = insert(OrthancCursor).values(name=name, seq=seq)
+    statement = statement.on_conflict_do_update(index_elements=[OrthancCursor.name],
+                                                set_={'seq': func.greatest(OrthancCursor.seq, statement.excluded.seq)})
+    with DBConn() as session:
+        session.execute(statement)
+
 def save_patient_metadata(metadata: OrthancMetadata):
     """
     Saves a patient id to the database for a study
@@ -88,20 +225,51 @@ def save_patient_metadata(metadata: OrthancMetadata):
         metadata (OrthancMetadata): metdata from orthanc
     """
 
-    with DBConn() as session:
-        study = session.query(Study).filter(Study.orthancStudyId == metadata.orthanc_id).scalar()
-        study.patientId = metadata.patient_id, 
-        study.modality = metadata.modality, 
-        study.studyUid = metadata.study_uid, 
-        study.seriesUid = metadata.series_uid, 
-        study.accession = metadata.accession,
-        study.description = metadata.description
-        # study.seriesMetadata = json.dumps(metadata.series_metadta)
-        # study.studyMetadata = json.dumps(metadata.study_metadta)
-        study.orthancParentId = metadata.parent_orthanc_id
+    save_studies_metadata([metadata])
 
+def save_studies_metadata(all_metadata: List[OrthancMetadata],
+                          study_types: Dict[str, str] = None):
+    """
+    Upserts the metadata, main DICOM tags and type of a batch of series with a single
+    statement
+
+    Args:
+        all_metadata (List[OrthancMetadata]): metdata from orthanc
+        study_types (Dict[str, str]): the type of each study keyed by orthanc id, studies
+            without a type keep the one they have
+    """
+    study_types = study_types or {}
+    now = int(time.time())
+    rows = {}
+    for metadata in all_metadata:
+        row = {
+            'orthancStudyId': metadata.orthanc_id,
+            'orthancParentId': metadata.parent_orthanc_id,
+            'patientId': metadata.patient_id,
+            'modality': metadata.modality,
+            'studyUid': metadata.study_uid,
+            'seriesUid': metadata.series_uid,
+            'accession': metadata.accession,
+            'description': metadata.description,
+            'type': study_types.get(metadata.orthanc_id),
+            'dateAdded': now,
+            # the main DICOM tags are small and the model router matches on them
+            'seriesMetadata': metadata.series_metadta,
+            'studyMetadata': metadata.study_metadta
+        }
+        # a row can only be updated once per statement
+        rows[metadata.orthanc_id] = row
+    if len(rows) == 0:
+        return
+
+    statement = insert(Study).values(list(rows.values()))
+    updated = {key: statement.excluded[key] for key in next(iter(rows.values()))
+               if key not in ('orthancStudyId', 'dateAdded', 'type')}
+    updated['type'] = func.coalesce(statement.excluded.type, Study.type)
+    statement = statement.on_conflict_do_update(index_elements=[Study.orthancStudyId], set_=updated)
+    with DBConn() as session:
+        session.execute(statement)
 
-                            
 
 def save_study_type(orthanc_id: str, study_type: str) -> Dict:
     """
@@ -138,42 +306,66 @@ def save_deleted_orthanc(orthanc_parent_id: str) -> Dict:
             s.deletedFromOrthanc = True
     return s
 
-def insert_studies(orthanc_ids: list) -> Dict:
+def insert_studies(orthanc_ids: List[str]) -> List[str]:
     """
-    Saves a study to the database with it accompanying type
+    Claims studies for ingestion by inserting the ones that are not in the database yet.
+    Ids that already exist, including ones another worker inserted concurrently, are
+    skipped so overlapping runs never fail or ingest a study twice
 
     Args:
-        orthanc_id (int): the study ID from orthanc
-        study_type (str): the type of the study (e.g. Frontal_CXR)
+        orthanc_ids (List[str]): the series IDs from orthanc
 
     Returns:
-        Dict: the inserted study as dict
+        List[str]: the orthanc ids this call inserted
     """
+    if len(orthanc_ids) == 0:
+        return []
+
+    now = int(time.time())
+    statement = insert(Study).\
+                    values([{'orthancStudyId': orthanc_id, 'dateAdded': now} for orthanc_id in set(orthanc_ids)]).\
+                    on_conflict_do_nothing(index_elements=[Study.orthancStudyId]).\
+                    returning(Study.orthancStudyId)
     with DBConn() as session:
-        if len(orthanc_ids) == 0:
-            return None
-        studies = [Study(orthancStudyId = orthanc_id, dateAdded= time.time()) for orthanc_id in orthanc_ids]
-
-        session.add_all(studies)
-        studies = session.query(Study).\
-                            filter(Study.orthancStudyId.in_(orthanc_ids)).\
-                            all()
+        claimed = {row.orthancStudyId for row in session.execute(statement)}
 
-
-    return studies
+    # keep the order the ids were found in
+    return [orthanc_id for orthanc_id in orthanc_ids if orthanc_id in claimed]
 
 def get_study_by_eval_id(eval_id):
     with DBConn() as session:
-        study = session.query(Study, StudyEvaluation).\
-                    filter(Study.id == StudyEvaluation.studyId).\
+        study = session.query(Study).\
+                    join(StudyEvaluation, StudyEvaluation.studyId == Study.id).\
                     filter(StudyEvaluation.id==eval_id).scalar()
 
     return study
 
+def get_orthanc_ids_by_eval_ids(eval_ids: List[int]) -> List[str]:
+    """
+    Gets the orthanc id of the study of each evaluation
+
+    Args:
+        eval_ids (List[int]): the db ids of the evaluations
+
+    Returns:
+        List[str]: one orthanc id per evaluation found, so a series shared by two evals appears twice
+    """
+    if len(eval_ids) == 0:
+        return []
+
+    with DBConn() as session:
+        rows = session.query(Study.orthancStudyId).\
+                    join(StudyEvaluation, StudyEvaluation.studyId == Study.id).\
+                    filter(StudyEvaluation.id.in_(eval_ids)).\
+                    all()
+    return [r.orthancStudyId for r in rows]
+
 def get_old_studies(time: int)-> List[str]:
     with DBConn() as session:
-        studies = session.query(Study).\
+        parents = session.query(Study.orthancParentId).\
                             filter(Study.dateAdded < time).\
                             filter(Study.deletedFromOrthanc == False).\
+                            filter(Study.orthancParentId != None).\
+                            distinct().\
                             all()
-    return [s.orthancParentId for s in studies]
\ No newline at end of file
+    return [p.orthancParentId for p in parents]
\ No newline at end of file
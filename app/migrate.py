@@ -0,0 +1,29 @@
+"""Creates the runner's tables and indexes. Run once per deploy before the workers start"""
+
+import sys
+import db.models as models
+from db import cache_db
+from utils import db_utils
+
+def migrate() -> bool:
+    """
+    Creates the runner tables, the indexes on the runner's hot queries that are
+    missing and the triggers that notify workers of changes to cached backend tables.
+    Index builds do not block writes but can take minutes on a large archive, which
+    is why they are not run from worker start up
+
+    Returns:
+        bool: whether every index was created
+    """
+    db_utils.init_db()
+    cache_db.install_change_triggers()
+    failed = db_utils.create_missing_indexes(db_utils.db_engine, models.RUNNER_INDEXES)
+    if len(failed) > 0:
+        print('could not create indexes:', ', '.join(failed))
+    return len(failed) == 0
+
+if __name__ == "__main__":
+    print('migrating runner schema')
+    succeeded = migrate()
+    db_utils.close_db_pool()
+    sys.exit(0 if succeeded else 1)
@@ -1,9 +1,172 @@
 import json
-from utils.db_utils import RabbitConn, init_db, init_rabbit
-from services import logger_service, classifier_service, eval_service, experiment_service, model_service, orthanc_service, study_service
+from utils.db_utils import RabbitConn, close_session, init_db, init_rabbit
+from utils import query_recorder
+from utils.worker_pool import OrderedWorkerPool
+from services import logger_service, classifier_service, eval_service, experiment_service, model_service, orthanc_service, settings_service
 from services import messaging_service
+import functools
 import json
+import threading
 import traceback
+from collections import defaultdict
+
+# returned by a handler that will ack its message itself once the work is committed
+DEFERRED = object()
+
+
+class WriteBehindBuffer:
+    """
+    Collects items taken from messages and writes them together once flush_size items
+    are waiting or flush_seconds have passed. Messages are only acked after the write
+    commits. Subclasses implement write and may override after_write and write_failed
+    """
+
+    def __init__(self, name: str, flush_size: int, flush_seconds: float):
+        self.flush_size = flush_size
+        self.flush_seconds = flush_seconds
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'{name}-flush', daemon=True)
+        self.thread.start()
+
+    def add(self, item, ch, method):
+        with self.pending_lock:
+            self.pending.append((item, ch, method))
+            full = len(self.pending) >= self.flush_size
+        if full:
+            self.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_seconds):
+            self.flush()
+            close_session()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+            if len(batch) == 0:
+                return
+            items = [item for item, _, _ in batch]
+            try:
+                self.write(items)
+            except:
+                traceback.print_exc()
+                self.write_failed(batch)
+                return
+            for _, ch, method in batch:
+                ack_message(ch, method)
+            try:
+                self.after_write(items)
+            except:
+                # the items are saved so only the follow up work is lost
+                traceback.print_exc()
+
+    def write(self, items):
+        raise NotImplementedError()
+
+    def after_write(self, items):
+        pass
+
+    def write_failed(self, batch):
+        # requeue once in case the database was unavailable
+        for _, ch, method in batch:
+            nack_message(ch, method, requeue=not method.redelivered)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+class ResultBuffer(WriteBehindBuffer):
+    """
+    Writes completed eval results with one bulk update. Notifications are sent after
+    the update commits
+    """
+
+    def __init__(self, flush_size: int, flush_seconds: float):
+        super().__init__('result', flush_size, flush_seconds)
+
+    def write(self, items):
+        eval_service.write_eval_results_bulk(items)
+
+    def after_write(self, items):
+        eval_service.finish_evals([eval_id for eval_id, _ in items])
+
+    def write_failed(self, batch):
+        # write one at a time so a single bad result does not fail the others
+        for (eval_id, result), ch, method in batch:
+            try:
+                save_eval_result(eval_id, result)
+                ack_message(ch, method)
+            except:
+                traceback.print_exc()
+                if not method.redelivered:
+                    # try again later in case the database was unavailable
+                    nack_message(ch, method, requeue=True)
+                    continue
+                eval_service.fail_dicom_eval(eval_id)
+                ack_message(ch, method)
+
+
+class LogBuffer(WriteBehindBuffer):
+    """
+    Coalesces the stdout lines of each eval over a short window and appends them
+    inside postgres with one statement
+    """
+
+    def __init__(self, flush_size: int, flush_seconds: float):
+        super().__init__('log', flush_size, flush_seconds)
+
+    def write(self, items):
+        lines_by_eval = defaultdict(list)
+        for eval_id, lines in items:
+            lines_by_eval[eval_id].extend(lines)
+        eval_service.append_eval_logs(lines_by_eval)
+
+
+result_buffer: ResultBuffer = None
+log_buffer: LogBuffer = None
+
+def ack_message(ch, method):
+    # pika channels may only be used from the thread running the connection
+    ch.connection.add_callback_threadsafe(functools.partial(ch.basic_ack, delivery_tag=method.delivery_tag))
+
+def nack_message(ch, method, requeue: bool):
+    ch.connection.add_callback_threadsafe(functools.partial(ch.basic_nack, delivery_tag=method.delivery_tag,
+                                                            requeue=requeue))
+
+def get_message_key(body) -> str:
+    try:
+        return str(json.loads(body).get('id'))
+    except:
+        return None
+
+def make_consumer(pool: OrderedWorkerPool, handler):
+    """
+    Wraps a message handler so it runs on the worker pool and the message is only
+    acked once the handler has committed its work
+    """
+    def on_message(ch, method, properties, body):
+        pool.submit(get_message_key(body), handle_and_ack, handler, ch, method, properties, body)
+    return on_message
+
+def handle_and_ack(handler, ch, method, properties, body):
+    query_recorder.start(handler.__name__)
+    try:
+        if handler(ch, method, properties, body) is not DEFERRED:
+            ack_message(ch, method)
+    except:
+        print('failed to handle message', body)
+        traceback.print_exc()
+        # requeue once so a transient failure does not lose the message
+        nack_message(ch, method, requeue=not method.redelivered)
+    finally:
+        query_recorder.stop()
+        # every message starts with a fresh session
+        close_session()
 
 def on_classifier_result(ch, method, properties, body):
     print(f'received classifier result {body}')
@@ -12,7 +175,7 @@ def on_classifier_result(ch, method, properties, body):
     result = message['output']
     classifier_service.save_classification(orthanc_id, result)
 
-    messaging_service.send_notification(f'Study {orthanc_id} ready', 'new_result', -1)
+    messaging_service.send_notification(f'Study {orthanc_id} ready', 'study_ready', -1)
 
 def on_eval_result(ch, method, properties, body):
     try:
@@ -23,25 +186,31 @@ def on_eval_result(ch, method, properties, body):
         msg_type = message['type']
         print('recieved result: ', result)
         if msg_type == 'START':
-            messaging_service.send_notification(f'Finished evaluation {eval_id}', 'new_result', -1)
-
+            # the eval_started notification was sent when the evaluation was queued
             eval_service.set_eval_as_running(eval_id)
             return
         if msg_type == 'FAIL' or type(result) is not dict:
             eval_service.fail_dicom_eval(eval_id)
+            eval_service.release_eval_dicom(eval_id)
             return
-        # write result to db
-        e = eval_service.write_eval_results(result, eval_id)
-
-        study = study_service.get_study_by_eval_id(eval_id)
-        # orthanc_service.delete_study_dicom(study['orthancStudyId'])
-        # send notification to frontend
-        messaging_service.send_notification(f'Finished evaluation {eval_id}', 'new_result', -1)
+        if result_buffer is not None:
+            # written, acked and notified when the buffer flushes
+            result_buffer.add((eval_id, result), ch, method)
+            return DEFERRED
+        save_eval_result(eval_id, result)
     except:
         eval_service.fail_dicom_eval(eval_id)
         print('failed to get result', body)
         traceback.print_stack()
 
+def save_eval_result(eval_id: int, result):
+    # write result to db
+    e = eval_service.write_eval_results(result, eval_id)
+
+    eval_service.release_eval_dicom(eval_id)
+    # send notification to frontend
+    messaging_service.send_notification(f'Finished evaluation {eval_id}', 'new_result', -1)
+
 def on_eval_log(ch, method, properties, body):
     try:
         print(f'received eval log {body}')
@@ -50,6 +219,10 @@ def on_eval_log(ch, method, properties, body):
         result = message['output'].split('\n')
         type = message['type']
         print(result)
+        if log_buffer is not None:
+            # appended and acked when the buffer flushes
+            log_buffer.add((eval_id, result), ch, method)
+            return DEFERRED
         eval_service.add_stdout_to_eval([eval_id], result)
     except:
         print('failed to log', body)
@@ -59,18 +232,34 @@ if __name__  == "__main__":
     print('starting results watcher')
     init_rabbit()
     init_db()
+    settings_service.refresh_settings(force=True)
+    settings_service.watch_reload_signal()
+    pool = OrderedWorkerPool(settings_service.get_results_workers())
+    result_buffer = ResultBuffer(*settings_service.get_results_flush_policy())
+    log_buffer = LogBuffer(*settings_service.get_log_flush_policy())
     with RabbitConn() as channel:
+        channel.basic_qos(prefetch_count=settings_service.get_results_prefetch())
         channel.queue_declare(messaging_service.EVAL_QUEUE)
         channel.queue_declare(messaging_service.CLASSIFIER_QUEUE)
         channel.queue_declare(messaging_service.LOG_QUEUE)
 
         channel.basic_consume(queue=messaging_service.CLASSIFIER_QUEUE, 
-                            on_message_callback=on_classifier_result, 
-                            auto_ack=True)
+                            on_message_callback=make_consumer(pool, on_classifier_result))
         channel.basic_consume(queue=messaging_service.EVAL_QUEUE, 
-                            on_message_callback=on_eval_result, 
-                            auto_ack=True)
+                            on_message_callback=make_consumer(pool, on_eval_result))
         channel.basic_consume(queue=messaging_service.LOG_QUEUE, 
-                            on_message_callback=on_eval_log, 
-                            auto_ack=True)
-        channel.start_consuming()
\ No newline at end of file
+                            on_message_callback=make_consumer(pool, on_eval_log))
+        try:
+            channel.start_consuming()
+        finally:
+            # stop deliveries, finish the messages already handed to the pool and write
+            # what is buffered. anything still unacked is redelivered once the channel closes
+            if channel.is_open:
+                for consumer_tag in list(channel.consumer_tags):
+                    channel.basic_cancel(consumer_tag)
+            pool.shutdown(wait=True)
+            result_buffer.stop()
+            log_buffer.stop()
+            # acks are queued for the connection thread, send them before the connection closes
+            if channel.is_open:
+                channel.connection.process_data_events(time_limit=0)
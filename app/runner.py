@@ -4,15 +4,16 @@ import traceback
 import uuid
 from typing import List
 from collections import defaultdict
-from utils.db_utils import close_db_pool, close_rabbit, init_db, init_rabbit
+from utils.db_utils import close_db_pool, close_rabbit, close_session, init_db, init_rabbit
 from services import messaging_service
 from celery import Celery
 import time
-from celery.signals import worker_process_init, worker_process_shutdown
+from celery.signals import task_postrun, task_prerun, worker_process_init, worker_process_shutdown
 
 
 import settings
-from services import logger_service, classifier_service, eval_service, experiment_service, model_service, orthanc_service, study_service
+from services import cache_service, logger_service, classifier_service, eval_service, experiment_service, model_service, orthanc_service, prefetch_service, settings_service, study_service
+from utils import query_recorder
 from utils import utils as uP
 
 runner = Celery('runner')
@@ -27,13 +28,30 @@ runner.control.purge()
 def init_worker(**kwargs):
     init_db()
     init_rabbit()
+    # load the settings once, later calls only check whether they changed
+    settings_service.refresh_settings(force=True)
+    settings_service.watch_reload_signal()
     print('starting worker')
 
 @worker_process_shutdown.connect
 def shutdown_worker(**kwargs):
+    prefetch_service.shutdown()
+    print('entity cache', cache_service.get_metrics())
+    print('orthanc latency', orthanc_service.get_latency_histograms())
+    messaging_service.flush_notifications()
     close_db_pool()
     close_rabbit()
 
+@task_prerun.connect
+def start_task_recording(task=None, **kwargs):
+    query_recorder.start(task.name)
+
+@task_postrun.connect
+def end_task_session(**kwargs):
+    query_recorder.stop()
+    # every task starts with a fresh session
+    close_session()
+
 @runner.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
     """set up celery beat tasks"""
@@ -49,13 +67,35 @@ def run_jobs():
     print('runnning jobs')
     jobs = eval_service.get_eval_jobs()
     print(f'found {len(jobs)} jobs to run')
+    for model_id, token in eval_service.sync_pending_evaluations(jobs):
+        backfill_routes.delay(model_id, token)
     for job in jobs:
         try:
             evaluate_studies.delay(job.modelId, 1, job.cpu)
+            # stage the studies after this batch while it runs
+            prefetch_service.prefetch_for_job(job, 1)
         except Exception as e:
             logger_service.log_error(f'{job.id} failed', traceback.format_exc())
             traceback.print_exc()
 
+@runner.task
+def backfill_routes(model_id: int, token: str):
+    """
+    Routes the next page of existing studies to a job that was just enabled and queues
+    itself for the page after, so other tasks run between pages
+
+    Args:
+        model_id (int): the db id of the model of the job
+        token (str): the token the backfill was claimed with
+    """
+    try:
+        if eval_service.backfill_pending_evaluations(model_id, token):
+            backfill_routes.delay(model_id, token)
+    except Exception as e:
+        # the backfill is started again once it times out
+        logger_service.log_error(f'backfill for model {model_id} failed', traceback.format_exc())
+        traceback.print_exc()
+
 
 @runner.task
 def classify_studies(batch_size: int):
@@ -67,11 +107,12 @@ def classify_studies(batch_size: int):
     """
     print('classifying studies')
 
-    new_studies = study_service.get_new_studies(batch_size)
+    new_studies, cursor = study_service.get_new_studies(batch_size)
 
     # check to make sure there are studies
     if len(new_studies) < 1:
         print('no new studies found')
+        study_service.save_ingest_cursor(cursor)
         return
 
     # download study metadata and classify
@@ -85,6 +126,9 @@ def classify_studies(batch_size: int):
     except Exception as e:
         classifier_service.fail_classification(new_studies)
 
+    # failed series are marked rather than read again so one bad series cannot stop ingestion
+    study_service.save_ingest_cursor(cursor)
+
 
 @runner.task
 def run_experiments(batch_size: int):
@@ -97,24 +141,27 @@ def run_experiments(batch_size: int):
     experiments = experiment_service.get_running_experiments()
     
     print(f'found {len(experiments)} experiments')
+    # read the progress counters of every experiment at once
+    progress = experiment_service.get_progress(experiments)
     # run experiments
     for experiment in experiments:
+        experiment_progress = progress.get(experiment.id)
         # check if the experiment is done and update as finished
-        if experiment_service.check_if_experiment_complete(experiment):
+        if experiment_service.is_complete(experiment_progress) and \
+                experiment_service.confirm_complete(experiment):
             experiment_service.finish_experiment(experiment)
             continue
         # get model
         model = model_service.get_model(experiment.modelId)
         # reset any failed evals associated with the experiment
-        eval_service.reset_failed_evals(experiment.id)
-        studies = experiment_service.get_experiment_studies(experiment.id)
-        # create batch of studies and check if there are already running studies
-        batch = studies[:batch_size]
-        running_studies = experiment_service.get_running_evals_by_exp(experiment.id)
-        print(running_studies)
-        print(batch)
+        restarted = eval_service.reset_failed_evals(experiment.id)
         # this makes it so there are only 5 evaluations
-        if len(batch) > 0 and len(running_studies) < 5:
+        if experiment_service.get_in_flight(experiment_progress) + len(restarted) >= 5:
+            continue
+        # create batch of studies
+        batch = experiment_service.get_experiment_studies(experiment.id, batch_size)
+        print(batch)
+        if len(batch) > 0:
             experiment_service.run_experiment(batch, model, experiment)
     print('finished experiment task')
 
@@ -131,15 +178,14 @@ def evaluate_studies(model_id: int, batch_size: int, cpu: bool = False):
     try:    
         # get all studies
         model = model_service.get_model(model_id)
-        studies = study_service.get_studies_for_model(model_id, batch_size)
+        # claim studies and create their evaluations in one step so concurrent
+        # tasks for the same model never pick the same studies
+        studies, eval_ids = eval_service.claim_studies(model, batch_size)
         # exit if no studies
         if len(studies) < 1:
             return
         # get the appropriate evaluating model
         print(f'found {len(studies)} studies for model {model.displayName}')
-        # create evaluations for all the studies and get their ids
-        failed_evals = eval_service.get_failed_eval_ids(model)
-        eval_ids = eval_service.create_evals(model, studies) + failed_evals
         # evaluate all studies with the model
         eval_service.evaluate_studies(studies, model, eval_ids, cpu)
     except Exception as e:
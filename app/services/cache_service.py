@@ -0,0 +1,165 @@
+"""Per worker read-through cache for model and eval job rows"""
+
+import copy
+import os
+import select
+import threading
+import time
+import traceback
+from collections import defaultdict
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from sqlalchemy import inspect
+
+from db import cache_db
+from services import settings_service
+
+# the cache namespaces that hold rows of each table, jobs carry their model
+TABLE_NAMESPACES = {
+    'model': ['model', 'eval_job'],
+    'eval_job': ['eval_job']
+}
+
+entries: Dict[Tuple[str, Hashable], Tuple[float, Any]] = {}
+generation = 0
+metrics = defaultdict(lambda: {'hits': 0, 'misses': 0, 'invalidations': 0})
+lock = threading.Lock()
+listener_lock = threading.Lock()
+listener = None
+listener_pid = None
+
+
+class Snapshot:
+    """
+    A read only copy of a db row that is safe to share between tasks and threads
+    """
+    __slots__ = ('_values',)
+
+    def __init__(self, values: Dict):
+        object.__setattr__(self, '_values', MappingProxyType(values))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{name} is read only on a cached snapshot')
+
+    def __repr__(self):
+        return f'Snapshot({dict(self._values)})'
+
+
+def snapshot(row, relationships=()):
+    """
+    Copies the columns and the given relationships of a row into a Snapshot
+    """
+    if row is None:
+        return None
+    mapper = inspect(row).mapper
+    values = {attr.key: copy.deepcopy(getattr(row, attr.key)) for attr in mapper.column_attrs}
+    for name in relationships:
+        values[name] = snapshot(getattr(row, name))
+    return Snapshot(values)
+
+def start_listener():
+    """
+    Listens for changes to the cached tables once per process. The triggers that
+    notify the listener are installed by migrate.py, without them or a listener
+    entries only expire by ttl
+    """
+    global listener, listener_pid
+    if listener_pid == os.getpid():
+        return
+    listener_pid = os.getpid()
+    listener = None
+    try:
+        listener = cache_db.open_listener()
+    except Exception:
+        print('could not listen for cache invalidations, falling back to ttl only')
+        traceback.print_exc()
+
+def poll_invalidations():
+    """
+    Drops the entries of tables that changed since the last poll without blocking
+    """
+    global listener
+    start_listener()
+    if listener is None:
+        return
+    try:
+        with listener_lock:
+            if not select.select([listener], [], [], 0)[0]:
+                return
+            listener.poll()
+            tables = {notify.payload for notify in listener.notifies}
+            listener.notifies.clear()
+    except Exception:
+        # notifications may have been missed so nothing cached can be trusted
+        traceback.print_exc()
+        listener = None
+        invalidate_all()
+        return
+    for table in tables:
+        invalidate(table)
+
+def get(namespace: str, key: Hashable, load: Callable[[], Any]) -> Any:
+    """
+    Returns the cached value or loads and caches it
+
+    Args:
+        namespace (str): the kind of value, invalidated when its table changes
+        key (Hashable): identifies the value within the namespace
+        load (Callable): loads the value on a miss, should return snapshots
+
+    Returns:
+        the cached value
+    """
+    poll_invalidations()
+    now = time.monotonic()
+    with lock:
+        entry = entries.get((namespace, key))
+        if entry is not None and entry[0] > now:
+            metrics[namespace]['hits'] += 1
+            return entry[1]
+        metrics[namespace]['misses'] += 1
+        loaded_generation = generation
+
+    value = load()
+    with lock:
+        # do not keep a value that was loaded while its table changed
+        if loaded_generation == generation:
+            entries[(namespace, key)] = (now + settings_service.get_entity_cache_ttl(), value)
+    return value
+
+def invalidate(table: str):
+    """
+    Drops the cached entries holding rows of a table
+    """
+    global generation
+    namespaces = TABLE_NAMESPACES.get(table, [table])
+    with lock:
+        generation += 1
+        for cache_key in [k for k in entries if k[0] in namespaces]:
+            del entries[cache_key]
+        for namespace in namespaces:
+            metrics[namespace]['invalidations'] += 1
+
+def invalidate_all():
+    global generation
+    with lock:
+        generation += 1
+        entries.clear()
+
+def get_metrics() -> Dict:
+    """
+    Returns the hits, misses, invalidations and hit rate of each namespace
+    """
+    with lock:
+        report = {}
+        for namespace, counts in metrics.items():
+            lookups = counts['hits'] + counts['misses']
+            report[namespace] = {**counts, 'hit_rate': counts['hits'] / lookups if lookups else 0.0}
+    return report
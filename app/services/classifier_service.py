@@ -1,10 +1,10 @@
 import traceback
-from typing import List
+from typing import Dict, List
 from services import messaging_service
 
 from db import study_db
 
-from services import logger_service, orthanc_service
+from services import logger_service, orthanc_service, routing_service
 
 
 def classify_studies(study_metadata: List[orthanc_service.OrthancMetadata]) -> None:
@@ -12,32 +12,42 @@ def classify_studies(study_metadata: List[orthanc_service.OrthancMetadata]) -> N
     Takes in a list of tuples containing (modality, study_paths) and will use that modality
     classifier to determine the study type.
     """
-    # TODO: seems like a lot of nested loops here...revisit and optimize
-    for metadata in study_metadata:
-        s = study_db.save_study_type(metadata.orthanc_id, metadata.modality)
-        messaging_service.send_notification(f'Study {metadata.orthanc_id} ready', 'study_ready', -1)
+    # the study types were saved with the metadata by study_service.save_study_metadata
+    messaging_service.send_notifications([f'Study {metadata.orthanc_id} ready' for metadata in study_metadata],
+                                         'study_ready', -1)
+    # TODO: implement study classification
+    # # evaluate the study using classifier model
+    # classifier_model = classifier_db.get_classifier_model(modality)
 
-        # TODO: implement study classification
-        # # evaluate the study using classifier model
-        # classifier_model = classifier_db.get_classifier_model(modality)
+    # # check to see if there is currently a classifier set for the given modality
+    # # if not just get the default one from the db
+    # if classifier_model is None:
+    #     classifier_model = eval_db.get_default_model()
 
-        # # check to see if there is currently a classifier set for the given modality
-        # # if not just get the default one from the db
-        # if classifier_model is None:
-        #     classifier_model = eval_db.get_default_model()
+    # # run studies through the classifier model
+    # eval_service.evaluate(classifier_model, study_paths, str(uuid.uuid4()))
 
-        # # run studies through the classifier model
-        # eval_service.evaluate(classifier_model, study_paths, str(uuid.uuid4()))
+    # queue the classified studies for every running job that takes them
+    routing_service.route_studies([routing_service.facts_from_metadata(metadata)
+                                   for metadata in study_metadata])
 
     
+def get_study_types(study_metadata: List[orthanc_service.OrthancMetadata]) -> Dict[str, str]:
+    """
+    Gets the type of each study keyed by orthanc id. Until classification is
+    implemented the modality is used as the type
+    """
+    return {metadata.orthanc_id: metadata.modality for metadata in study_metadata}
+
 def fail_classification(orthanc_ids):
         # catch errors and print output
     print('classification of study', orthanc_ids, 'failed')
     traceback.print_exc()
     logger_service.log_error(f'classfying {orthanc_ids} failed', traceback.format_exc())
-    # remove studies from the db that failed on classfication
-    for orthanc_id in orthanc_ids:
-        study_db.remove_study_by_id(orthanc_id)
+    # keep the failed studies so a series that always fails is not ingested again
+    study_db.fail_studies(orthanc_ids)
 
 def save_classification(orthanc_id, result):
-    study_db.save_study_type(orthanc_id, result['display'])
\ No newline at end of file
+    study_db.save_study_type(orthanc_id, result['display'])
+    study = study_db.get_study_by_orthanc_id(orthanc_id)
+    routing_service.route_studies([routing_service.facts_from_study(study, result['display'])])
\ No newline at end of file
@@ -1,35 +1,36 @@
 from tkinter import E
 import uuid
 import traceback
-from typing import List
+from typing import List, Tuple
 from services import messaging_service
 from db.models import Model, Study, StudyEvaluation
-from db import eval_db, model_db, study_db
+from db import eval_db, study_db
 
 import docker
 import nvidia_smi
 
-from services import logger_service, orthanc_service
+from services import logger_service, model_service, routing_service, staging_service
 from medaimodels import ModelOutput
-import json
 
 from kubernetes import client, config
 from pprint import pprint
-import json
 from uuid import uuid4
 
 JOB_NAMESPACE = "default"
 config.load_incluster_config()
 
 
-def create_evals(model: Model, studies: List[Study]) -> List[int]:
-    # add db entries for the upcoming study evals
-    eval_ids = eval_db.start_study_evaluations(studies, model.id)
-    return eval_ids
+def create_evals(model: Model, studies: List[Study]) -> Tuple[List[Study], List[int]]:
+    # add db entries for the upcoming study evals. studies that already have one are skipped
+    return eval_db.create_evaluations(studies, model.id)
 
-def get_failed_eval_ids(model: Model):
-    failed_evals = eval_db.get_failed_eval_ids(model.id)
-    return eval_db.restart_failed_evals(failed_evals) or []
+def claim_studies(model: Model, batch_size: int) -> Tuple[List[Study], List[int]]:
+    # reserve studies for this worker and create their evals
+    studies, eval_ids = eval_db.claim_studies(model.id, batch_size)
+    if len(studies) > 0:
+        messaging_service.send_notifications([f"Started evaluation of study {study.orthancStudyId}" for study in studies],
+                                             'eval_started', -1, group=f'model {model.displayName}')
+    return studies, eval_ids
 
 def reset_failed_evals(experimentId: int) -> List[str]:
     eval_ids = eval_db.get_failed_eval_ids_by_exp(experimentId)
@@ -42,16 +43,16 @@ def evaluate_studies(studies: List[Study], model: Model, eval_ids: List[int], cp
         orthanc_ids = [study.orthancStudyId for study in studies]
         evaluate(model, orthanc_ids, str(uuid.uuid4()), eval_ids, cpu=cpu)
     except:
-        fail_evals(model.id, eval_ids)
+        fail_evals(model, eval_ids)
 
-def fail_evals(model_id: int, eval_ids: List[int]):
+def fail_evals(model: Model, eval_ids: List[int]):
     traceback.print_exc()
-    error_message = f'evaluation using model {model_id} failed'
+    error_message = f'evaluation using model {model.id} failed'
     logger_service.log_error(error_message, traceback.format_exc())
 
     for eval_id in eval_ids:
         e: StudyEvaluation = eval_db.fail_eval(eval_id)
-        messaging_service.send_notification(error_message, 'eval_failed', -1)
+        messaging_service.send_notification(error_message, 'eval_failed', -1, group=f'model {model.displayName}')
 
 def fail_model(model_id: int):
     # TODO: this doesn't seem like it does anything
@@ -62,7 +63,15 @@ def fail_model(model_id: int):
     messaging_service.send_notification(error_message, 'eval_failed')
 
 def get_eval_jobs():
-    return eval_db.get_eval_jobs()
+    return model_service.get_running_jobs()
+
+def sync_pending_evaluations(jobs) -> List[Tuple[int, str]]:
+    # claim the backfill of the work queue of jobs that were just enabled
+    return routing_service.sync_backfills([job.modelId for job in jobs])
+
+def backfill_pending_evaluations(model_id: int, token: str) -> bool:
+    # route the next page of existing studies, true while there are more
+    return routing_service.backfill_page(model_id, token)
 
 def create_eval(orthanc_id: str, model_id: int) -> int:
     """
@@ -79,7 +88,8 @@ def evaluate_with_quickstart(model: Model,
                              orthanc_ids: List[str], 
                              db_ids: List[int] = None):
 
-    [orthanc_service.download_study_dicom(orthanc_id) for orthanc_id in orthanc_ids]
+    saved_seconds = staging_service.acquire_series(orthanc_ids)
+    report_prefetch_savings(db_ids, saved_seconds)
 
     message = {
         'files': orthanc_ids,
@@ -87,7 +97,10 @@ def evaluate_with_quickstart(model: Model,
         'type': 'EVAL'
     }
     print(f'sending message {message} to {str(model.id)}')
-    messaging_service.send_message(str(model.id), json.dumps(message))
+    if not messaging_service.send_message(str(model.id), message):
+        # no quickstart pod will release the series, the caller fails the evals
+        staging_service.release_series(orthanc_ids)
+        raise ConnectionError(f'could not send evals {db_ids} to model {model.id}')
 
 def evaluate(model: Model, 
              orthanc_ids: List[str], 
@@ -108,7 +121,7 @@ def evaluate(model: Model,
         A list of the outputs of the evaluating model
     """
 
-    job = model_db.get_job_by_model(model.id)
+    job = model_service.get_job_by_model(model.id)
     if(job.replicas > 0):
         print('running with quickstart')
         evaluate_with_quickstart(model, orthanc_ids, db_ids)
@@ -139,15 +152,44 @@ def evaluate(model: Model,
 
     print('downloading dicoms for studies: ', orthanc_ids)
 
-    [orthanc_service.download_study_dicom(orthanc_id) for orthanc_id in orthanc_ids]
+    saved_seconds = staging_service.acquire_series(orthanc_ids)
+    report_prefetch_savings(db_ids, saved_seconds)
 
+    try:
+        start_k8_job(model.image, result_queue, filenames, uuid, ids)
+    except:
+        staging_service.release_series(orthanc_ids)
+        raise
 
-    start_k8_job(model.image, result_queue, filenames, uuid, ids)    
 
+def report_prefetch_savings(eval_ids: List[int], saved_seconds: float):
+    message = f'prefetching saved {saved_seconds:.1f}s of downloading for evals {eval_ids}'
+    print(message)
+    logger_service.log(message, {'evalIds': eval_ids, 'savedSeconds': saved_seconds})
 
 def write_eval_results(results, eval_id: int):
     return eval_db.update_eval_status_and_save(results, eval_id)
 
+def write_eval_results_bulk(results):
+    eval_db.complete_evals(results)
+
+def finish_evals(eval_ids: List[int]):
+    """
+    Releases the staged series of evals whose results have been written and tells the
+    frontend about them
+    """
+    staging_service.release_series(study_db.get_orthanc_ids_by_eval_ids(eval_ids))
+    messaging_service.send_notifications([f'Finished evaluation {eval_id}' for eval_id in eval_ids], 'new_result', -1)
+
+def release_eval_dicom(eval_id: int):
+    """
+    Drops the staging reference taken for an eval once it has finished. The series
+    stays on disk for other models until it is evicted
+    """
+    study = study_db.get_study_by_eval_id(eval_id)
+    if study:
+        staging_service.release_series([study.orthancStudyId])
+
 def fail_dicom_eval(eval_id):
     traceback.print_exc()
     error_message = f'evaluation for study {eval_id} failed'
@@ -169,6 +211,9 @@ def remove_orphan_evals():
 def add_stdout_to_eval(ids, stdout):
     eval_db.add_stdout_to_eval(ids, stdout)
 
+def append_eval_logs(lines_by_eval):
+    eval_db.append_stdout_bulk(lines_by_eval)
+
 def start_k8_job(image, result_queue, filenames, uuid, ids):
     config.load_incluster_config()
 
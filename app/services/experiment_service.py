@@ -1,3 +1,4 @@
+import time
 import traceback
 from typing import Dict, List
 from services import messaging_service
@@ -5,7 +6,7 @@ from db import experiment_db
 
 
 from db.models import Experiment, Study
-from services import eval_service, logger_service
+from services import eval_service, logger_service, settings_service
 
 
 
@@ -13,8 +14,40 @@ def get_running_experiments():
     return experiment_db.get_running_experiments()
 
 
-def get_experiment_studies(experiment_id: int) -> List[Study]:
-    return experiment_db.get_studies_for_experiment(experiment_id)
+def get_experiment_studies(experiment_id: int, limit: int = None) -> List[Study]:
+    return experiment_db.get_studies_for_experiment(experiment_id, limit)
+
+
+def get_progress(experiments: List[Experiment]) -> Dict[int, object]:
+    """
+    Gets the progress counters of experiments with one query. Experiments that were
+    never counted or were counted longer ago than the reseed interval are recounted
+    with one aggregate query, which also corrects any drift in the counters
+    """
+    experiment_ids = [experiment.id for experiment in experiments]
+    progress = experiment_db.get_progress(experiment_ids)
+    stale_before = time.time() - settings_service.get_experiment_progress_reseed()
+    stale = [i for i in experiment_ids if i not in progress or progress[i].seededAt < stale_before]
+    progress.update(experiment_db.seed_progress(stale))
+    return progress
+
+
+def is_complete(progress) -> bool:
+    # every study has a completed or failed evaluation. experiments without studies
+    # have no progress row and are complete
+    return progress is None or progress.completed + progress.failed >= progress.total
+
+
+def get_in_flight(progress) -> int:
+    # evaluations that were created but have not completed or failed yet
+    return 0 if progress is None else progress.started - progress.completed - progress.failed
+
+
+def confirm_complete(experiment: Experiment) -> bool:
+    """
+    Recounts an experiment that the counters show as complete before it is finished
+    """
+    return is_complete(experiment_db.seed_progress([experiment.id]).get(experiment.id))
 
 
 def finish_experiment(experiment: Experiment):
@@ -25,9 +58,7 @@ def finish_experiment(experiment: Experiment):
 
 
 def check_if_experiment_complete(experiment: Experiment) -> bool:
-    evals_left = experiment_db.get_studies_for_experiment(experiment.id)
-    evals_running = experiment_db.get_running_studies_for_experiment(experiment.id)
-    return len(evals_left) + len(evals_running) < 1
+    return confirm_complete(experiment)
 
 
 def fail_experiment(experiment: Experiment):
@@ -49,7 +80,8 @@ def run_experiment(studies, model, experiment):
     try:
         print('\n\n\nstarting experiment batch\n\n\n')
         # run experiment
-        eval_ids = eval_service.create_evals(model, studies)
+        studies, eval_ids = eval_service.create_evals(model, studies)
+        experiment_db.add_started(experiment.id, len(eval_ids))
 
         eval_service.evaluate_studies(studies, model, eval_ids)
         # finish experiment and set it as completed
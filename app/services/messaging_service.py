@@ -1,44 +1,224 @@
 """Utilities for sending rabbitmq messages"""
 
+from typing import Dict, List, Union
 from db.models import User
-from utils.db_utils import RabbitConn
+from utils.db_utils import RabbitConn, get_rabbit_parameters
+import atexit
+import threading
 import pika
-from services import logger_service
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+from services import logger_service, settings_service
 import json
 import traceback
 from medaimodels import ModelOutput
 import services
-import json
 
 CLASSIFIER_QUEUE = 'classifier_results'
 EVAL_QUEUE = 'eval_results'
 LOG_QUEUE = 'log_results'
+NOTIFICATION_QUEUE = 'notifications'
+
+# sent instead of the individual notifications when several of a type are coalesced
+NOTIFICATION_SUMMARIES = {
+    'eval_started': 'Started {count} evaluations',
+    'eval_failed': '{count} evaluations failed',
+    'new_result': 'Finished {count} evaluations',
+    'study_ready': '{count} studies ready',
+}
+
+
+class Publisher:
+    """
+    Long lived connection used to publish messages. Queues are only declared the first
+    time they are published to and the connection is reopened if the broker drops it.
+
+    confirms is one of:
+        'none': publish without waiting for the broker
+        'each': wait for a publisher confirm after every message
+        'batch': publish a whole batch in a transaction and wait once when it commits
+    """
+
+    def __init__(self, parameters: pika.URLParameters, confirms: str = 'none'):
+        self.parameters = parameters
+        self.confirms = confirms
+        self.connection = None
+        self.channel = None
+        self.declared_queues = set()
+        # pika connections are not thread safe
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.connection = pika.BlockingConnection(self.parameters)
+        self.channel = self.connection.channel()
+        if self.confirms == 'each':
+            self.channel.confirm_delivery()
+        elif self.confirms == 'batch':
+            self.channel.tx_select()
+        self.declared_queues = set()
+
+    def is_open(self) -> bool:
+        return self.connection is not None and self.connection.is_open and self.channel.is_open
+
+    def publish(self, queue: str, bodies: List[str]):
+        """
+        Publishes every body to a queue, reconnecting once if the connection was lost.
+        Messages of a batch that failed part way may be sent twice after a reconnect
+        """
+        with self.lock:
+            try:
+                self.publish_batch(queue, bodies)
+            except (AMQPConnectionError, AMQPChannelError):
+                print(f'lost connection to rabbitmq while publishing to {queue}, reconnecting')
+                self.close_connection()
+                self.publish_batch(queue, bodies)
+
+    def publish_batch(self, queue: str, bodies: List[str]):
+        if not self.is_open():
+            self.connect()
+        if queue not in self.declared_queues:
+            self.channel.queue_declare(queue)
+            self.declared_queues.add(queue)
+        for body in bodies:
+            self.channel.basic_publish(exchange='', routing_key=queue, body=body)
+        if self.confirms == 'batch':
+            self.channel.tx_commit()
+
+    def close_connection(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except:
+            traceback.print_exc()
+        self.connection = None
+        self.channel = None
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
+
+
+class NotificationAggregator:
+    """
+    Buffers notifications per type, user and group for a short window and then sends
+    one summary per buffer, e.g. "Started 250 evaluations for model X". A buffer with
+    a single notification is sent unchanged. Types in immediate_types skip the buffer
+    """
+
+    def __init__(self, window_seconds: float, immediate_types: List[str]):
+        self.window_seconds = window_seconds
+        self.immediate_types = set(immediate_types)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
 
-def send_message(queue: str, message, user_id: int=-1):
+    def add(self, msgs: List[str], notification_type: str, user_id: int, group: str = None):
+        if self.window_seconds <= 0 or notification_type in self.immediate_types:
+            send_messages(NOTIFICATION_QUEUE, [{"message": msg, "type": notification_type} for msg in msgs], user_id)
+            return
+        with self.lock:
+            self.pending.setdefault((notification_type, user_id, group), []).extend(msgs)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='notification-flush', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.window_seconds):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for (notification_type, user_id, group), msgs in pending.items():
+            if len(msgs) == 1:
+                message = msgs[0]
+            else:
+                summary = NOTIFICATION_SUMMARIES.get(notification_type, '{count} notifications')
+                message = summary.format(count=len(msgs))
+                if group:
+                    message = f'{message} for {group}'
+            send_messages(NOTIFICATION_QUEUE,
+                          [{"message": message, "type": notification_type, "count": len(msgs)}],
+                          user_id)
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+publisher = None
+aggregator = None
+
+def get_publisher() -> Publisher:
+    global publisher
+    if publisher is None:
+        publisher = Publisher(get_rabbit_parameters(), settings_service.get_publish_confirms())
+    return publisher
+
+def get_aggregator() -> NotificationAggregator:
+    global aggregator
+    if aggregator is None:
+        aggregator = NotificationAggregator(settings_service.get_notification_window(),
+                                            settings_service.get_immediate_notification_types())
+    return aggregator
+
+@atexit.register
+def close_publisher():
+    if publisher is not None:
+        publisher.close()
+
+# registered after close_publisher so it runs first at exit
+@atexit.register
+def flush_notifications():
+    if aggregator is not None:
+        aggregator.stop()
+
+def send_messages(queue: str, messages: List[Union[Dict, str]], user_id: int=-1) -> bool:
+    """
+    Sends many messages to a queue over the shared publisher connection
+
+    Args:
+        queue (str): the queue to send to
+        messages (List[Union[Dict, str]]): the messages as dicts or json strings
+        user_id (int): the id of the user the messages are for
+
+    Returns:
+        bool: whether the messages were sent, failures are logged and not raised
+    """
+    if len(messages) == 0:
+        return True
     try:
-        with RabbitConn() as channel:
-            msg_json = json.loads(message)
-            channel.queue_declare(queue)
+        bodies = []
+        for message in messages:
+            msg_json = json.loads(message) if isinstance(message, str) else dict(message)
             msg_json['userId'] = user_id
-            message = json.dumps(msg_json)
+            bodies.append(json.dumps(msg_json))
 
-            channel.basic_publish(exchange='',
-                                    routing_key=queue,
-                                    body=message)
-            print(f'sent message to {queue}: {message}')
+        get_publisher().publish(queue, bodies)
+        print(f'sent {len(bodies)} messages to {queue}')
+        return True
     except:
-        print(f'Failed sending message to {queue}, message: {message}', traceback.format_exc())
+        print(f'Failed sending messages to {queue}, messages: {messages}', traceback.format_exc())
+        return False
+
+def send_message(queue: str, message: Union[Dict, str], user_id: int=-1) -> bool:
+    return send_messages(queue, [message], user_id)
+
+
+def send_notification(msg: str, notification_type: str, user_id: int=-1, group: str=None):
+    """Send notification to the message queue. Notifications of a type are coalesced
+    per user and group for a short window"""
+    get_aggregator().add([msg], notification_type, user_id, group)
 
 
-def send_notification(msg: str, notification_type: str, user_id: int):
-    """Send notification to the message queue"""
-    message = json.dumps({"message": msg, "type": notification_type})
-    send_message('notifications', message, user_id)
+def send_notifications(msgs: List[str], notification_type: str, user_id: int=-1, group: str=None):
+    """Send many notifications of the same type to the message queue"""
+    if len(msgs) > 0:
+        get_aggregator().add(msgs, notification_type, user_id, group)
 
 
 def send_model_log(eval_id: str, line: str):
-    message = json.dumps({"evalId": eval_id, "line": line})
-    send_message('model_log', message)
+    send_message('model_log', {"evalId": eval_id, "line": line})
 
 
 def start_result_queue():
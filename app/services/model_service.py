@@ -4,10 +4,10 @@ from numpy import imag
 
 from sqlalchemy import false
 from services import messaging_service
-from db import model_db
+from db import eval_db, model_db
 from db.models import EvalJob, Model
 import docker
-from services import settings_service
+from services import cache_service, settings_service
 from kubernetes import client, config
 
 
@@ -15,7 +15,16 @@ def sanitize_model_name(name):
     return ''.join(e for e in name if (e.isalnum() or e=='-')) + 'x'
 
 def get_model(model_id: int) -> Model:
-    return model_db.get_model(model_id)
+    return cache_service.get('model', model_id,
+                             lambda: cache_service.snapshot(model_db.get_model(model_id)))
+
+def get_job_by_model(model_id: int) -> EvalJob:
+    return cache_service.get('eval_job', ('model', model_id),
+                             lambda: cache_service.snapshot(model_db.get_job_by_model(model_id), ['model']))
+
+def get_running_jobs() -> List[EvalJob]:
+    return cache_service.get('eval_job', 'running',
+                             lambda: [cache_service.snapshot(job, ['model']) for job in eval_db.get_eval_jobs()])
 
 def get_jobs_to_quickstart():
     jobs:List[EvalJob] = model_db.get_jobs_to_quickstart()
@@ -57,7 +66,9 @@ def quickstart_model(job: EvalJob, cpu: boolean = False):
         raise
 
 def turn_off_all_models():
-    return model_db.stop_all_models()
+    stopped = model_db.stop_all_models()
+    cache_service.invalidate('model')
+    return stopped
 
 def update_deployment_replicas(deployment, num, client_instance):
     deployment.spec.replicas = num
@@ -0,0 +1,108 @@
+"""Pooled HTTP client shared by every request the runner makes to orthanc"""
+
+import asyncio
+import functools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import requests
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+# orthanc ids are five groups of eight hex characters separated by dashes
+ORTHANC_ID_PATTERN = re.compile(r'[0-9a-f]{8}(?:-[0-9a-f]{8}){4}')
+
+
+class OrthancClient:
+    """
+    Keeps a pool of keep-alive connections to orthanc and records the latency of every
+    request per endpoint. It is safe to share between threads
+    """
+
+    def __init__(self, url: str, pool_size: int = 16, timeout: Tuple[float, float] = (5, 60)):
+        self.url = url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.histograms = {}
+        self.histograms_lock = threading.Lock()
+
+    def request(self, method: str, path: str, **kwargs) -> Response:
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, f'{self.url}{path}', **kwargs)
+        finally:
+            self.record_latency(method, path, time.perf_counter() - start)
+
+    def get(self, path: str, **kwargs) -> Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> Response:
+        return self.request('POST', path, **kwargs)
+
+    def record_latency(self, method: str, path: str, seconds: float):
+        # /series/<id>/archive and /series/<other id>/archive share a histogram
+        endpoint = f"{method} {ORTHANC_ID_PATTERN.sub('{id}', path)}"
+        with self.histograms_lock:
+            histogram = self.histograms.setdefault(endpoint, {
+                'count': 0,
+                'sum': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+            })
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            bucket = next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)
+            histogram['buckets'][bucket] += 1
+
+    def get_latency_histograms(self) -> Dict[str, Dict]:
+        """
+        Returns:
+            Dict[str, Dict]: count, sum and per bucket counts keyed by endpoint. Bucket
+            i counts requests that took at most LATENCY_BUCKETS[i] seconds
+        """
+        with self.histograms_lock:
+            return {endpoint: {**h, 'buckets': list(h['buckets'])} for endpoint, h in self.histograms.items()}
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncOrthancClient:
+    """
+    Runs requests of an OrthancClient from asyncio with at most max_concurrency of them
+    in flight. The requests share the connection pool of the wrapped client
+    """
+
+    def __init__(self, client: OrthancClient, max_concurrency: int = 8):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='orthanc')
+
+    async def request(self, semaphore: asyncio.Semaphore, method: str, path: str, **kwargs) -> Response:
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            call = functools.partial(self.client.request, method, path, **kwargs)
+            return await loop.run_in_executor(self.executor, call)
+
+    async def get_many(self, paths: List[str], **kwargs) -> List[Response]:
+        """
+        Gets every path concurrently
+
+        Returns:
+            List[Response]: the responses in the same order as paths
+        """
+        # created here so it belongs to the running event loop
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        return await asyncio.gather(*[self.request(semaphore, 'GET', path, **kwargs) for path in paths])
+
+    def close(self):
+        self.executor.shutdown(wait=False)
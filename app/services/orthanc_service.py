@@ -1,21 +1,40 @@
 from ast import Or
 from operator import mod
+import asyncio
 import os
 import shutil
+import threading
+import tempfile
 import json
 import traceback
 from zipfile import ZipFile
-from typing import Dict, List, NamedTuple
+from typing import Dict, List, NamedTuple, Tuple
 from db import study_db
 import nvidia_smi
 import glob
-import requests
 from requests import Response
+from concurrent.futures import ThreadPoolExecutor
 import redis
 import docker
 from medaimodels import ModelOutput
 from settings import settings_service
+from services.orthanc_client import AsyncOrthancClient, OrthancClient
 from dataclasses import dataclass
+from cachetools import LRUCache
+
+# shared volume that downloaded series are extracted to. mounted in model containers
+IMAGES_DIR = '/opt/images'
+
+# change types in the orthanc /changes feed that announce a series
+SERIES_CHANGE_TYPES = ('NewSeries', 'StableSeries')
+
+# main dicom tags of parent studies shared by sibling series, keyed by orthanc study id
+study_info_cache = LRUCache(maxsize=4096)
+
+# pooled clients shared by every request to orthanc made by this process
+client = None
+async_client = None
+client_lock = threading.Lock()
 
 class OrthancMetadata(NamedTuple):
     orthanc_id: str
@@ -31,12 +50,63 @@ class OrthancMetadata(NamedTuple):
     parent_orthanc_id: str
 
 def download_metadata(orthanc_id: str):
-    # Get orthanc url from setting
-    orthanc_url = settings_service.get_orthanc_url()
-
     # Get relevant data from series metadata
-    series_url = f'{orthanc_url}/series/{orthanc_id}'
-    series_info = requests.get(series_url).json()
+    series_info = get_client().get(f'/series/{orthanc_id}').json()
+    study_id = series_info['ParentStudy']
+
+    # Get relevant data from stuudy metadata
+    study_info = get_client().get(f'/studies/{study_id}').json()
+
+    return build_metadata(orthanc_id, series_info, study_info)
+
+def download_metadata_batch(orthanc_ids: List[str]) -> List[OrthancMetadata]:
+    """
+    Retrieves the metadata of many series and their parent studies in two requests
+    using /tools/bulk-content. Parent studies shared by sibling series are cached.
+    Falls back to download_metadata on orthanc versions without bulk-content
+
+    Args:
+        orthanc_ids (List[str]): the series IDs for orthanc
+
+    Returns
+        :List[OrthancMetadata]: the metadata in the same order as orthanc_ids
+    """
+    if len(orthanc_ids) == 0:
+        return []
+
+    series_infos = get_bulk_content(orthanc_ids)
+    if series_infos is None:
+        return [download_metadata(orthanc_id) for orthanc_id in orthanc_ids]
+
+    # only fetch the parent studies that are not cached yet
+    study_ids = {info['ParentStudy'] for info in series_infos.values()}
+    missing_study_ids = [s for s in study_ids if s not in study_info_cache]
+    study_infos = get_bulk_content(missing_study_ids) if missing_study_ids else {}
+    study_info_cache.update(study_infos)
+
+    all_metadata = []
+    for orthanc_id in orthanc_ids:
+        series_info = series_infos[orthanc_id]
+        study_info = study_info_cache[series_info['ParentStudy']]
+        all_metadata.append(build_metadata(orthanc_id, series_info, study_info))
+    return all_metadata
+
+def get_bulk_content(orthanc_ids: List[str]) -> Dict[str, Dict]:
+    """
+    Gets the expanded content of many orthanc resources in one request
+
+    Returns
+        :Dict[str, Dict]: the resources keyed by orthanc id or None if orthanc does
+        not support /tools/bulk-content
+    """
+    body = {"Resources": orthanc_ids}
+    res: Response = get_client().post('/tools/bulk-content', data=json.dumps(body))
+    if res.status_code == 404:
+        return None
+    res.raise_for_status()
+    return {resource['ID']: resource for resource in res.json()}
+
+def build_metadata(orthanc_id: str, series_info: Dict, study_info: Dict) -> OrthancMetadata:
     main_series_tags = series_info.get('MainDicomTags', {})
     series_uid = main_series_tags.get('SeriesInstanceUID', '')
     description = main_series_tags.get('PerformedProcedureStepDescription', '')
@@ -44,9 +114,6 @@ def download_metadata(orthanc_id: str):
     study_id = series_info['ParentStudy']
     instances = list(series_info.get('Instances', {}))
 
-    # Get relevant data from stuudy metadata
-    study_info_url = f'{orthanc_url}/studies/{study_id}'
-    study_info = requests.get(study_info_url).json()
     main_study_metadata = study_info.get('MainDicomTags', {})
     study_uid = main_study_metadata.get('StudyInstanceUID', '')
     accession = main_study_metadata.get('AccessionNumber', '')
@@ -64,25 +131,26 @@ def download_metadata(orthanc_id: str):
         series_metadta=main_series_tags,
         study_metadta=main_study_metadata,
         parent_orthanc_id=study_id
-    )   
+    )
 
 
-def save_series_preview(metadata: OrthancMetadata):
-    # Get orthanc url from setting
-    orthanc_url = settings_service.get_orthanc_url()
+def get_preview_path(metadata: OrthancMetadata) -> str:
     # get a preview of the first instance in the series
     first_instance_id = metadata.series_instances[0]
-    study_png = requests.get(f'{orthanc_url}/instances/{first_instance_id[0]}/preview', stream=True)
+    return f'/instances/{first_instance_id}/preview'
 
+def write_series_preview(metadata: OrthancMetadata, preview: Response):
     # define download path for study
-    out_path = f'/opt/images/{metadata.orthanc_id}'
+    out_path = f'{IMAGES_DIR}/{metadata.orthanc_id}'
     png_path = f'{out_path}.png'
 
-    study_file = open(png_path, 'wb')
+    with open(png_path, 'wb') as study_file:
+        study_file.write(preview.content)
+
+def save_series_preview(metadata: OrthancMetadata):
+    study_png = get_client().get(get_preview_path(metadata))
+    write_series_preview(metadata, study_png)
 
-    study_file.write(study_png.content)
-    study_file.close()
-    
 
 def get_study_metadata(orthanc_id: str) -> OrthancMetadata:
     """
@@ -102,6 +170,26 @@ def get_study_metadata(orthanc_id: str) -> OrthancMetadata:
 
     return metadata
 
+def get_studies_metadata(orthanc_ids: List[str]) -> List[OrthancMetadata]:
+    """
+    Retreive many studies from orthanc with batched metadata requests
+
+    Args:
+        orthanc_ids (List[str]): the study IDs for orthanc
+
+    Returns
+        :List[OrthancMetadata]
+    """
+    all_metadata = download_metadata_batch(orthanc_ids)
+
+    # fetch the previews concurrently over the pooled connections
+    paths = [get_preview_path(metadata) for metadata in all_metadata]
+    previews = asyncio.run(get_async_client().get_many(paths))
+    for metadata, preview in zip(all_metadata, previews):
+        write_series_preview(metadata, preview)
+
+    return all_metadata
+
 def get_modality(orthanc_id: str) -> str:
     """
     Gets the modality of an orthanc study by orthanc id
@@ -112,13 +200,26 @@ def get_modality(orthanc_id: str) -> str:
     Returns
         :str: the modality of the study
     """
-    orthanc_url = settings_service.get_orthanc_url()
-    preview_url = f'{orthanc_url}/series/{orthanc_id}'
-    series_info = requests.get(preview_url).json()
+    series_info = get_client().get(f'/series/{orthanc_id}').json()
 
     return series_info.get('MainDicomTags', {} ).get('Modality')
 
 
+def get_series_instances(orthanc_id: str) -> List[str]:
+    """
+    Gets the orthanc ids of the instances in a series
+
+    Args:
+        orthanc_id: the id of the series from orthanc
+
+    Returns
+        :List[str]: the instance ids
+    """
+    series_info = get_client().get(f'/series/{orthanc_id}').json()
+
+    return list(series_info.get('Instances', []))
+
+
 def get_orthanc_study_ids():
     """
     Retrieve orthanc study ids from orthanc
@@ -126,41 +227,231 @@ def get_orthanc_study_ids():
     Returns
         :obj:`list` of :obj:`int`: a list of the orhthan IDs
     """
-    orthanc_url = settings_service.get_orthanc_url()
-    url = f'{orthanc_url}/series'
-    studies = requests.get(url)
+    studies = get_client().get('/series')
 
     return studies.json()
 
-def download_study_dicom(orthanc_id: str):
+def get_changes(since: int, limit: int) -> Dict:
+    """
+    Retrieve a page of the orthanc change log
+
+    Args:
+        since (int): the sequence number to start after
+        limit (int): the maximum number of changes to return
+
+    Returns
+        :Dict: the orthanc response containing Changes, Done and Last
+    """
+    changes = get_client().get('/changes', params={'since': since, 'limit': limit})
+
+    return changes.json()
+
+def get_new_series_ids(since: int, max_series: int, page_size: int = 1000) -> Tuple[List[str], int]:
     """
+    Reads the orthanc change log after a sequence number and collects the ids of
+    series that were added. Reading stops once max_series ids are found so the
+    returned sequence number never skips past a series that was not returned
+
+    Args:
+        since (int): the sequence number to start after
+        max_series (int): the maximum number of series ids to return
+        page_size (int): the number of changes to request at a time
+
+    Returns
+        :Tuple[List[str], int]: the series ids and the sequence number to resume from
+    """
+    series_ids = []
+    seen = set()
+    last_seq = since
+    done = False
+    while not done and len(series_ids) < max_series:
+        changes = get_changes(last_seq, page_size)
+        done = changes.get('Done', True) or len(changes.get('Changes', [])) == 0
+        for change in changes.get('Changes', []):
+            last_seq = change['Seq']
+            if change['ChangeType'] not in SERIES_CHANGE_TYPES or change['ID'] in seen:
+                continue
+            seen.add(change['ID'])
+            series_ids.append(change['ID'])
+            if len(series_ids) == max_series:
+                break
+
+    return series_ids, last_seq
+
+def get_client() -> OrthancClient:
+    """
+    Gets the pooled orthanc client of this process. A new client is created if the
+    orthanc url setting changed
     """
+    global client, async_client
     orthanc_url = settings_service.get_orthanc_url()
-    media_url = f'{orthanc_url}/series/{orthanc_id}/archive'
+    with client_lock:
+        if client is None or client.url != orthanc_url.rstrip('/'):
+            if client is not None:
+                client.close()
+            if async_client is not None:
+                async_client.close()
+                async_client = None
+            client = OrthancClient(orthanc_url,
+                                   pool_size=settings_service.get_orthanc_pool_size(),
+                                   timeout=settings_service.get_orthanc_timeouts())
+        return client
+
+def reset_clients(previous: Dict, current: Dict):
+    """
+    Closes the pooled clients when the orthanc url setting changes so the next
+    request connects to the new url
+    """
+    global client, async_client
+    if previous['orthancUrl'] == current['orthancUrl']:
+        return
+    with client_lock:
+        if async_client is not None:
+            async_client.close()
+            async_client = None
+        if client is not None:
+            client.close()
+            client = None
+
+settings_service.on_settings_change(reset_clients)
+
+def get_async_client() -> AsyncOrthancClient:
+    """
+    Gets an asyncio wrapper around the pooled orthanc client of this process
+    """
+    global async_client
+    orthanc_client = get_client()
+    with client_lock:
+        if async_client is None:
+            async_client = AsyncOrthancClient(orthanc_client, settings_service.get_orthanc_concurrency())
+        return async_client
+
+def get_latency_histograms() -> Dict[str, Dict]:
+    """
+    Gets the request latency histograms of the pooled client, empty if this process
+    has not made any orthanc requests
+    """
+    if client is None:
+        return {}
+    return client.get_latency_histograms()
+
+def download_study_dicom(orthanc_id: str, instance_ids: List[str] = None):
+    """
+    Downloads a series from orthanc to /opt/images/{orthanc_id} using the configured
+    download mode. 'archive' fetches the series as a single zip and 'instances'
+    fetches the instance files concurrently
+
+    Args:
+        orthanc_id (str): the series ID for orthanc
+        instance_ids (List[str]): the instances of the series if they are already known
+    """
+    if settings_service.get_download_mode() == 'instances':
+        download_series_instances(orthanc_id, instance_ids)
+    else:
+        download_series_archive(orthanc_id)
+
+def make_staging_dir(orthanc_id: str) -> str:
+    """
+    Creates a hidden directory next to the final series path to download into. The
+    images volume is shared with the model containers, which may run as another user,
+    so the directory gets the same 0755 mode a plain mkdir would give it instead of
+    the 0700 of mkdtemp
+    """
+    # staging files live on the same volume as the output so the rename is atomic
+    tmp_dir = tempfile.mkdtemp(prefix=f'.{orthanc_id}.', dir=IMAGES_DIR)
+    os.chmod(tmp_dir, 0o755)
+    return tmp_dir
+
+def download_series_archive(orthanc_id: str):
+    """
+    Downloads a series archive from orthanc and extracts it to /opt/images/{orthanc_id}.
+    The archive is streamed to disk in chunks so memory use is bounded by the download
+    chunk size no matter how large the series is. The series is extracted next to its
+    final path and renamed into place so a partially downloaded series is never visible
+
+    Args:
+        orthanc_id (str): the series ID for orthanc
+    """
+    media_url = f'/series/{orthanc_id}/archive'
+    chunk_size = settings_service.get_download_chunk_size()
+    out_path = f'{IMAGES_DIR}/{orthanc_id}'
     print(f'downloading {orthanc_id} from orthanc using {media_url}')
-    study = requests.get(media_url)
-    out_path = f'/opt/images/{orthanc_id}'
-    file_path = f'{out_path}.zip'
-    # write the downloaded study to disk
-    open(file_path, 'wb').write(study.content)
-    print(f'writing to {file_path}')
 
-    with ZipFile(file_path, 'r') as zip_obj:
-        zip_obj.extractall(out_path)
+    tmp_dir = make_staging_dir(orthanc_id)
+    zip_path = f'{tmp_dir}.zip'
+    try:
+        with get_client().get(media_url, stream=True) as study:
+            study.raise_for_status()
+            with open(zip_path, 'wb') as zip_file:
+                for chunk in study.iter_content(chunk_size=chunk_size):
+                    zip_file.write(chunk)
+        print(f'extracting {zip_path} to {out_path}')
+
+        # members are copied to disk one buffer at a time
+        with ZipFile(zip_path, 'r') as zip_obj:
+            zip_obj.extractall(tmp_dir)
+
+        shutil.rmtree(out_path, ignore_errors=True)
+        os.rename(tmp_dir, out_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+
+def download_series_instances(orthanc_id: str, instance_ids: List[str] = None):
+    """
+    Downloads every instance of a series from orthanc in parallel so a large series is
+    not limited to one connection and orthanc's zip packing. Files are written to a
+    hidden directory and renamed into place once all of them are downloaded
+
+    Args:
+        orthanc_id (str): the series ID for orthanc
+        instance_ids (List[str]): the instances of the series if they are already known
+    """
+    if instance_ids is None:
+        instance_ids = get_series_instances(orthanc_id)
+    orthanc_client = get_client()
+    chunk_size = settings_service.get_download_chunk_size()
+    concurrency = settings_service.get_download_concurrency()
+    out_path = f'{IMAGES_DIR}/{orthanc_id}'
+    print(f'downloading {len(instance_ids)} instances of {orthanc_id} using {concurrency} connections')
+
+    tmp_dir = make_staging_dir(orthanc_id)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # list() re-raises the first failed download
+            list(executor.map(lambda i: download_instance(orthanc_client, i, tmp_dir, chunk_size), instance_ids))
+
+        shutil.rmtree(out_path, ignore_errors=True)
+        os.rename(tmp_dir, out_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def download_instance(orthanc_client: OrthancClient, instance_id: str, out_dir: str, chunk_size: int):
+    """
+    Streams a single instance file from orthanc to {out_dir}/{instance_id}.dcm
+    """
+    file_url = f'/instances/{instance_id}/file'
+    with orthanc_client.get(file_url, stream=True) as instance:
+        instance.raise_for_status()
+        with open(f'{out_dir}/{instance_id}.dcm', 'wb') as instance_file:
+            for chunk in instance.iter_content(chunk_size=chunk_size):
+                instance_file.write(chunk)
 
 def delete_study_dicom(orthanc_id: str):
     """
     """
-    out_path = f'/opt/images/{orthanc_id}'
+    out_path = f'{IMAGES_DIR}/{orthanc_id}'
     file_path = f'{out_path}.zip'
 
-    os.remove(file_path)
+    if os.path.exists(file_path):
+        os.remove(file_path)
     shutil.rmtree(out_path, ignore_errors=True)
 
 def delete_all_downloaded():
     """
     """
-    fileList = glob.glob('/opt/images/*')
+    fileList = glob.glob(f'{IMAGES_DIR}/*')
     # Iterate over the list of filepaths & remove each file.
     for filePath in fileList:
         try:
@@ -171,11 +462,9 @@ def delete_all_downloaded():
             print("Error while deleting file : ", filePath)
 
 def delete_from_orthanc(orthanc_ids: List[str]):
-    orthanc_url = settings_service.get_orthanc_url()
-    bulk_delete_url = f'{orthanc_url}/tools/bulk-delete'
     body = {"Resources": orthanc_ids}
     print('posting with body ', json.dumps(body))
-    res: Response = requests.post(bulk_delete_url, data=json.dumps(body))
+    res: Response = get_client().post('/tools/bulk-delete', data=json.dumps(body))
     print(res)
     if res.status_code == 200:
         for o in orthanc_ids:
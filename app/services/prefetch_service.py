@@ -0,0 +1,60 @@
+"""Stages series for running eval jobs in the background before they are dispatched"""
+
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from db import pending_db
+from db.models import EvalJob
+from services import logger_service, settings_service, staging_service
+from utils.db_utils import close_session
+
+executor = None
+in_flight = set()
+in_flight_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=settings_service.get_prefetch_workers(),
+                                      thread_name_prefix='prefetch')
+    return executor
+
+def prefetch_for_job(job: EvalJob, batch_size: int):
+    """
+    Looks past the batch that is about to be dispatched for a job and starts staging
+    the series that come after it
+
+    Args:
+        job (EvalJob): the running eval job
+        batch_size (int): the number of studies the current dispatch will take
+    """
+    lookahead = settings_service.get_prefetch_lookahead(job.modelId)
+    if lookahead < 1:
+        return
+
+    studies = pending_db.peek_studies(job.modelId, batch_size, lookahead)
+    for study in studies:
+        submit(study.orthancStudyId)
+
+def submit(orthanc_id: str):
+    with in_flight_lock:
+        if orthanc_id in in_flight:
+            return
+        in_flight.add(orthanc_id)
+    get_executor().submit(prefetch, orthanc_id)
+
+def prefetch(orthanc_id: str):
+    try:
+        staging_service.prefetch_series(orthanc_id)
+    except:
+        # the series is downloaded again on dispatch so a failed prefetch only costs time
+        logger_service.log_error(f'prefetching {orthanc_id} failed', traceback.format_exc())
+        traceback.print_exc()
+    finally:
+        close_session()
+        with in_flight_lock:
+            in_flight.discard(orthanc_id)
+
+def shutdown():
+    if executor is not None:
+        executor.shutdown(wait=False)
@@ -0,0 +1,251 @@
+"""Routes classified studies to the models that take them"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from db import model_db, pending_db, study_db
+from db.models import Study
+from services import logger_service, orthanc_service, settings_service
+from services.orthanc_service import OrthancMetadata
+from utils.utils import divide_chunks
+
+
+class StudyFacts(NamedTuple):
+    orthanc_id: str
+    modality: str
+    type: str
+    description: str
+    tags: Dict
+
+
+class Route:
+    """
+    The input criteria of one model compiled for matching.
+
+    Model.input is either a plain study type name, which keeps the old modality only
+    routing, or a json object with any of:
+        types: a study type or list of study types
+        description: a regex searched in the study description (case insensitive)
+        tags: a map of DICOM tag name to a regex matched against the tag value
+    """
+
+    def __init__(self, model_id: int, modality: str, model_input: str):
+        criteria = parse_criteria(model_input)
+        types = criteria.get('types')
+        if isinstance(types, str):
+            types = [types]
+
+        self.model_id = model_id
+        self.modality = modality
+        self.types = set(types) if types else None
+        self.description = re.compile(criteria['description'], re.IGNORECASE) \
+                            if criteria.get('description') else None
+        self.tags = [(tag, re.compile(pattern)) for tag, pattern in criteria.get('tags', {}).items()]
+
+    def matches(self, facts: StudyFacts) -> bool:
+        if self.types is not None and facts.type not in self.types:
+            return False
+        if self.description is not None and not self.description.search(facts.description or ''):
+            return False
+        for tag, pattern in self.tags:
+            value = facts.tags.get(tag)
+            if value is None or not pattern.fullmatch(str(value)):
+                return False
+        return True
+
+
+class RoutingTable:
+    """
+    Routes of the running models indexed by modality. Routes are recompiled only for
+    models whose criteria changed since the last refresh
+    """
+
+    def __init__(self):
+        self.routes: Dict[int, Route] = {}
+        self.signatures: Dict[int, Tuple] = {}
+        self.by_modality: Dict[str, List[Route]] = {}
+        self.lock = threading.Lock()
+
+    def update(self, models: Iterable):
+        with self.lock:
+            current = {m.id: (m.modality, m.input, m.inputType) for m in models}
+            changed = False
+
+            for model_id in set(self.signatures) - set(current):
+                self.routes.pop(model_id, None)
+                del self.signatures[model_id]
+                changed = True
+
+            for model_id, signature in current.items():
+                if self.signatures.get(model_id) == signature:
+                    continue
+                modality, model_input, _ = signature
+                try:
+                    self.routes[model_id] = Route(model_id, modality, model_input)
+                except (re.error, AttributeError, TypeError, ValueError) as e:
+                    # the model gets no studies until its criteria are fixed, which
+                    # changes the signature and compiles the route again
+                    print(f'invalid input criteria for model {model_id}, not routing to it:', e)
+                    logger_service.log_error(f'invalid input criteria for model {model_id}', traceback.format_exc())
+                    self.routes.pop(model_id, None)
+                self.signatures[model_id] = signature
+                changed = True
+
+            if changed:
+                by_modality = defaultdict(list)
+                for route in self.routes.values():
+                    by_modality[route.modality].append(route)
+                self.by_modality = dict(by_modality)
+
+    def get_signature(self, model_id: int) -> str:
+        """
+        Gets a stable hash of the criteria a model's route was compiled from
+        """
+        return hashlib.sha1(json.dumps(self.signatures[model_id]).encode()).hexdigest()
+
+    def match(self, facts: StudyFacts) -> List[int]:
+        candidates = self.by_modality.get(facts.modality, [])
+        return [route.model_id for route in candidates if route.matches(facts)]
+
+
+routing_table = RoutingTable()
+
+def parse_criteria(model_input: str) -> Dict:
+    """
+    Parses the json criteria of a model input, plain study type names have none.
+    Raises ValueError for an input that looks like a json object but does not parse
+    """
+    try:
+        criteria = json.loads(model_input)
+    except (TypeError, ValueError):
+        if isinstance(model_input, str) and model_input.lstrip().startswith('{'):
+            raise
+        return {}
+    return criteria if isinstance(criteria, dict) else {}
+
+def facts_from_metadata(metadata: OrthancMetadata) -> StudyFacts:
+    # classification currently saves the modality as the study type
+    return StudyFacts(metadata.orthanc_id, metadata.modality, metadata.modality,
+                      metadata.description, {**metadata.study_metadta, **metadata.series_metadta})
+
+def facts_from_study(study: Study, study_type: str = None) -> StudyFacts:
+    tags = {**(study.studyMetadata or {}), **(study.seriesMetadata or {})}
+    return StudyFacts(study.orthancStudyId, study.modality, study_type or study.type,
+                      study.description, tags)
+
+def refresh_routes():
+    """
+    Recompiles the routes of running models whose criteria changed
+    """
+    routing_table.update(model_db.get_routing_models())
+
+def route_studies(facts: List[StudyFacts]):
+    """
+    Matches a batch of studies against every running model in one pass and queues
+    each study for the models that take it
+
+    Args:
+        facts (List[StudyFacts]): the routing fields of the classified studies
+    """
+    refresh_routes()
+    routes = [(model_id, f.orthanc_id) for f in facts for model_id in routing_table.match(f)]
+    pending_db.enqueue_routes(routes)
+
+def fill_missing_tags(studies: List, facts: List[StudyFacts], chunk_size: int = 100) -> List[StudyFacts]:
+    """
+    Fetches the main DICOM tags of studies that were saved before the tags were stored
+    and saves them, so models with tag criteria can be backfilled. Studies whose tags
+    cannot be fetched keep none and are not matched by tag criteria
+
+    Args:
+        studies (List): rows of get_unevaluated_studies
+        facts (List[StudyFacts]): the routing fields of the same rows
+
+    Returns:
+        List[StudyFacts]: the routing fields with the fetched tags
+    """
+    missing = [study.orthancStudyId for study in studies
+               if study.seriesMetadata is None and not study.deletedFromOrthanc]
+    tags = {}
+    for chunk in divide_chunks(missing, chunk_size):
+        try:
+            all_metadata = orthanc_service.download_metadata_batch(chunk)
+        except Exception as e:
+            print(f'could not fetch the tags of {len(chunk)} series:', e)
+            continue
+        study_db.save_studies_metadata(all_metadata)
+        tags.update((m.orthanc_id, facts_from_metadata(m).tags) for m in all_metadata)
+    return [f._replace(tags=tags[f.orthanc_id]) if f.orthanc_id in tags else f for f in facts]
+
+def sync_backfills(running_model_ids: List[int]) -> List[Tuple[int, str]]:
+    """
+    Finds the jobs that were just enabled, and the jobs whose model criteria changed
+    since they were backfilled, and claims their backfill. The studies are routed by
+    backfill_page so a large archive does not hold up the caller
+
+    Args:
+        running_model_ids (List[int]): the model ids of the running eval jobs
+
+    Returns:
+        List[Tuple[int, str]]: the model id and token of each backfill to start
+    """
+    backfilled = pending_db.remove_stopped(running_model_ids)
+    refresh_routes()
+
+    signatures = {model_id: routing_table.get_signature(model_id)
+                  for model_id in running_model_ids if model_id in routing_table.routes}
+    for model_id in pending_db.save_route_signatures(signatures):
+        print(f'input criteria of model {model_id} changed, routing its studies again')
+        pending_db.reset_backfill(model_id)
+        backfilled.discard(model_id)
+
+    stale_before = int(time.time()) - settings_service.get_backfill_timeout()
+    started = []
+    for model_id in running_model_ids:
+        if model_id in backfilled or model_id not in routing_table.routes:
+            continue
+        token = str(uuid.uuid4())
+        if pending_db.start_backfill(model_id, token, stale_before):
+            print(f'backfilling pending evaluations for model {model_id}')
+            started.append((model_id, token))
+    return started
+
+def backfill_page(model_id: int, token: str) -> bool:
+    """
+    Routes the next page of studies a model has not evaluated and saves how far the
+    backfill got
+
+    Args:
+        model_id (int): the db id of the model
+        token (str): the token the backfill was claimed with
+
+    Returns:
+        bool: whether there are more studies to route
+    """
+    after_id = pending_db.get_backfill_position(model_id, token)
+    if after_id is None:
+        # the backfill was reset or taken over
+        return False
+    refresh_routes()
+    route = routing_table.routes.get(model_id)
+    if route is None:
+        return False
+
+    page_size = settings_service.get_backfill_page_size()
+    studies = study_db.get_unevaluated_studies(model_id, route.modality, after_id, page_size)
+    facts = [facts_from_study(study) for study in studies]
+    if len(route.tags) > 0:
+        facts = fill_missing_tags(studies, facts)
+    pending_db.enqueue_routes([(model_id, f.orthanc_id) for f in facts if route.matches(f)])
+    if len(studies) < page_size:
+        pending_db.finish_backfill(model_id, token)
+        print(f'backfilled pending evaluations for model {model_id}')
+        return False
+    return pending_db.advance_backfill(model_id, token, studies[-1].id)
@@ -0,0 +1,171 @@
+"""Reference counted cache of series downloaded to the shared images volume"""
+
+import hashlib
+import os
+import shutil
+import time
+import traceback
+import uuid
+from typing import Dict, List
+from db import staging_db
+from services import logger_service, orthanc_service, settings_service
+
+# how often an eval checks whether another worker finished downloading a series
+LEASE_POLL_SECONDS = 1
+
+# per process counters, reported with get_metrics
+metrics = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'bytes_downloaded': 0,
+    'bytes_evicted': 0,
+}
+
+def get_series_path(orthanc_id: str) -> str:
+    return f'{orthanc_service.IMAGES_DIR}/{orthanc_id}'
+
+def hash_instances(instance_ids: List[str]) -> str:
+    """
+    Orthanc ids are derived from the DICOM UIDs so the sorted instance ids identify
+    the exact content of a series. A series that gains instances gets a new hash
+    """
+    return hashlib.sha1('\n'.join(sorted(instance_ids)).encode()).hexdigest()
+
+def get_directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+def acquire_series(orthanc_ids: List[str]) -> float:
+    """
+    Makes sure each series is staged on disk and takes a reference on it so it is not
+    evicted while an eval is using it. Every call must be paired with release_series
+
+    Args:
+        orthanc_ids (List[str]): the orthanc series ids
+
+    Returns:
+        float: seconds of downloading saved because the series were prefetched
+    """
+    acquired = []
+    saved_seconds = 0
+    try:
+        for orthanc_id in orthanc_ids:
+            saved_seconds += stage_series(orthanc_id)
+            acquired.append(orthanc_id)
+    except:
+        release_series(acquired)
+        raise
+    evict_if_needed()
+    return saved_seconds
+
+def prefetch_series(orthanc_id: str):
+    """
+    Stages a series ahead of the eval that will use it without taking a reference.
+    A series that another worker is already downloading is left to that worker
+    """
+    stage_series(orthanc_id, references=0)
+    evict_if_needed()
+
+def is_staged(entry, instances_hash: str, orthanc_id: str) -> bool:
+    return entry is not None and entry.instancesHash == instances_hash and \
+            os.path.isdir(get_series_path(orthanc_id))
+
+def stage_series(orthanc_id: str, references: int = 1) -> float:
+    """
+    Takes references on a series and downloads it unless the same instances are
+    already staged. Downloads hold a lease in the db so a series is only downloaded by
+    one worker at a time. An eval that finds a download in progress, for example a
+    prefetch, waits for it instead of downloading the series again
+
+    Returns:
+        float: seconds of downloading saved if a prefetched series was used
+    """
+    instance_ids = orthanc_service.get_series_instances(orthanc_id)
+    instances_hash = hash_instances(instance_ids)
+    entry = staging_db.add_reference(orthanc_id, references)
+    owner = uuid.uuid4().hex
+    lease_timeout = settings_service.get_staging_lease_timeout()
+
+    try:
+        while not is_staged(entry, instances_hash, orthanc_id):
+            if staging_db.take_lease(orthanc_id, instances_hash, owner, lease_timeout):
+                # the series may have been staged between the check and the lease
+                entry = staging_db.get_staged(orthanc_id)
+                if is_staged(entry, instances_hash, orthanc_id):
+                    staging_db.release_lease(orthanc_id, owner)
+                    break
+                download_series(orthanc_id, instance_ids, instances_hash, owner, references == 0)
+                return 0
+            if references == 0:
+                return 0
+            # another worker is downloading the series, wait for it to finish
+            while staging_db.has_lease(orthanc_id):
+                time.sleep(LEASE_POLL_SECONDS)
+            entry = staging_db.get_staged(orthanc_id)
+    except:
+        if references > 0:
+            staging_db.release_references([orthanc_id])
+        raise
+
+    metrics['hits'] += 1
+    if references > 0 and entry.prefetched:
+        staging_db.clear_prefetched(orthanc_id)
+        return entry.downloadSeconds or 0
+    return 0
+
+def download_series(orthanc_id: str, instance_ids: List[str], instances_hash: str, owner: str, prefetched: bool):
+    """
+    Downloads a series while holding its lease and records it as staged
+    """
+    metrics['misses'] += 1
+    start = time.time()
+    try:
+        orthanc_service.download_study_dicom(orthanc_id, instance_ids)
+        download_seconds = time.time() - start
+        size = get_directory_size(get_series_path(orthanc_id))
+        metrics['bytes_downloaded'] += size
+        staging_db.save_staged(orthanc_id, instances_hash, size, download_seconds, prefetched)
+    finally:
+        staging_db.release_lease(orthanc_id, owner)
+
+def release_series(orthanc_ids: List[str]):
+    """
+    Drops the references taken by acquire_series. Released series stay on disk until
+    they are evicted
+    """
+    staging_db.release_references(orthanc_ids)
+
+def remove_series(orthanc_id: str):
+    size = get_directory_size(get_series_path(orthanc_id))
+    orthanc_service.delete_study_dicom(orthanc_id)
+    metrics['evictions'] += 1
+    metrics['bytes_evicted'] += size
+
+def evict_if_needed():
+    """
+    Evicts least recently used series once disk usage passes the high watermark until
+    it drops below the low watermark
+    """
+    try:
+        usage = shutil.disk_usage(orthanc_service.IMAGES_DIR)
+        high, low = settings_service.get_staging_watermarks()
+        if usage.used < usage.total * high:
+            return
+
+        bytes_to_free = usage.used - int(usage.total * low)
+        stale_before = int(time.time()) - settings_service.get_staging_reference_timeout()
+        evicted = staging_db.evict_series(bytes_to_free, stale_before, remove_series)
+        print(f'evicted {len(evicted)} staged series', get_metrics())
+    except:
+        # eviction is best effort and should never fail an eval
+        logger_service.log_error('evicting staged series failed', traceback.format_exc())
+        traceback.print_exc()
+
+def get_metrics() -> Dict:
+    lookups = metrics['hits'] + metrics['misses']
+    hit_rate = metrics['hits'] / lookups if lookups else 0
+    return {**metrics, 'hit_rate': hit_rate}
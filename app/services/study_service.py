@@ -1,8 +1,21 @@
-from typing import List
+import time
+from typing import List, NamedTuple, Tuple
 from collections import defaultdict
 from db import study_db
 
-from services import orthanc_service
+from services import classifier_service, orthanc_service, settings_service
+from utils.utils import divide_chunks
+
+CHANGES_CURSOR = 'changes'
+
+
+class IngestCursor(NamedTuple):
+    # the change sequence to resume from
+    seq: int
+    # every series read from the change log up to seq
+    series_ids: List[str]
+    # the series this run claimed
+    claimed_ids: List[str]
 
 
 def get_studies_for_model(model_id: int, batch_size: int):
@@ -11,42 +24,94 @@ def get_studies_for_model(model_id: int, batch_size: int):
     studies = studies[:batch_size]
     return studies
 
-def get_new_studies(batch_size: int) -> list[str]:
+def get_new_studies(batch_size: int) -> Tuple[List[str], IngestCursor]:
     """
-    takes in a batch size and returns the same number of orthanc ids that have not yet 
-    been downloaded to the db
+    takes in a batch size and returns up to the same number of orthanc ids that have not yet 
+    been downloaded to the db. Only the ids this worker claimed are returned
+
+    Returns:
+        Tuple[List[str], IngestCursor]: the claimed orthanc ids and, in changes mode, the
+            cursor to save with save_ingest_cursor once they are classified or failed
     """
+    if settings_service.get_ingest_mode() == 'changes':
+        return get_new_studies_from_changes(batch_size)
+
     # get orthanc study ids from orthanc
     orthanc_studies = orthanc_service.get_orthanc_study_ids()
 
-    # get ids of studies that have already been processed and saved to the db
-    db_orthanc_ids = map(lambda x: x.orthancStudyId, study_db.get_studies())
+    # filter out studies that have already been saved to the db, the db ids are
+    # streamed so only the orthanc listing is held in memory
+    remaining = set(orthanc_studies)
+    for orthanc_id in study_db.iter_orthanc_ids():
+        remaining.discard(orthanc_id)
+    filtered_studies = list(remaining)[:batch_size]
+
+    # only the studies this worker inserted are returned so overlapping runs split them
+    return study_db.insert_studies(filtered_studies), None
 
-    # filter out studies that have already been evaluated
-    # TODO: this should be done with a db call the dose WHERE NOT IN ()
-    filtered_studies = list(set(orthanc_studies) - set(db_orthanc_ids))
-    filtered_studies = filtered_studies[:batch_size]
+def get_new_studies_from_changes(batch_size: int) -> Tuple[List[str], IngestCursor]:
+    """
+    takes in a batch size and returns up to that many orthanc ids read from the orthanc
+    change log since the last run. Only the new series are touched so the cost does not
+    grow with the size of the archive. The cursor is not moved here so a batch is read
+    again if the worker dies before it is classified
+    """
+    since = study_db.get_orthanc_cursor(CHANGES_CURSOR)
+    series_ids, last_seq = orthanc_service.get_new_series_ids(since, batch_size)
+
+    # StableSeries follows NewSeries for the same series so skip ones already saved
+    existing_ids = set(study_db.get_existing_orthanc_ids(series_ids))
+    new_studies = [s for s in series_ids if s not in existing_ids]
+
+    claimed_ids = study_db.insert_studies(new_studies)
+    return claimed_ids, IngestCursor(last_seq, series_ids, claimed_ids)
+
+def save_ingest_cursor(cursor: IngestCursor):
+    """
+    Moves the change log cursor past a batch once it has been classified or failed.
+    An overlapping run may have claimed series of the same batch, the cursor stays
+    put until that run is done with them so they are read again if it dies. Claims
+    older than the classify timeout are failed so a dead run does not stall ingestion
+    """
+    if cursor is None:
+        return
 
-    study_db.insert_studies(filtered_studies)
+    stale_before = int(time.time()) - settings_service.get_classify_timeout()
+    claimed = set(cursor.claimed_ids)
+    in_flight = []
+    abandoned = []
+    for study in study_db.get_unclassified_studies(cursor.series_ids):
+        if study.orthancStudyId in claimed:
+            continue
+        if study.dateAdded < stale_before:
+            abandoned.append(study.orthancStudyId)
+        else:
+            in_flight.append(study.orthancStudyId)
 
-    return filtered_studies
+    if len(abandoned) > 0:
+        print('failing series abandoned during ingestion', abandoned)
+        study_db.fail_studies(abandoned)
+    if len(in_flight) > 0:
+        print(f'{len(in_flight)} series before change {cursor.seq} are still being classified, not moving the cursor')
+        return
+    study_db.save_orthanc_cursor(CHANGES_CURSOR, cursor.seq)
 
 def save_study_metadata(orthanc_ids: List[str]) -> List[orthanc_service.OrthancMetadata]:
     # download metadata for all studies
-    all_metadata = [orthanc_service.get_study_metadata(orthanc_id) for orthanc_id in orthanc_ids]
-    # save metadata to db 
-    [study_db.save_patient_metadata(metadata) for metadata in all_metadata]
+    all_metadata = orthanc_service.get_studies_metadata(orthanc_ids)
+    # save the metadata and type of the whole batch in one statement
+    study_db.save_studies_metadata(all_metadata, classifier_service.get_study_types(all_metadata))
     return all_metadata
 
 def refresh_orthanc_data():
-    studies = study_db.get_studies()
     print('updating studies')
-    for study in studies:
-        orthanc_id = study.orthancStudyId
-        # download study from orthanc to disk
-        metadata = orthanc_service.get_study_metadata(orthanc_id)
+    # the ids are read up front since saving metadata commits the session
+    orthanc_ids = study_db.get_orthanc_ids()
+    for chunk in divide_chunks(orthanc_ids, 100):
+        # download study metadata from orthanc in batches
+        all_metadata = orthanc_service.get_studies_metadata(chunk)
         # save the patient id
-        study_db.save_patient_metadata(metadata)
+        study_db.save_studies_metadata(all_metadata)
 
 def remove_orphan_studies():
     study_db.remove_orphan_studies()
@@ -0,0 +1,77 @@
+"""Counts and times the sql statements run by each task"""
+
+import os
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event
+
+recording = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in budget test mode when a task runs more statements than its budget"""
+
+
+def get_query_budget() -> int:
+    """
+    the number of statements a task may run, 0 disables the budget
+    """
+    return int(os.getenv('QUERY_BUDGET') or 0)
+
+def is_budget_enforced() -> bool:
+    """
+    'fail' raises QueryBudgetExceeded when a task goes over budget, 'warn' only reports it
+    """
+    return (os.getenv('QUERY_BUDGET_MODE') or 'warn').lower() == 'fail'
+
+def install(engine):
+    """
+    Hooks the recorder into the statement events of an engine
+    """
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats = getattr(recording, 'stats', None)
+    if stats is None:
+        return
+    stats['count'] += 1
+    stats['seconds'] += elapsed
+    stats['statements'][' '.join(statement.split())[:120]] += 1
+
+    budget = get_query_budget()
+    if budget and stats['count'] > budget and is_budget_enforced():
+        raise QueryBudgetExceeded(f'{stats["name"]} ran more than {budget} statements')
+
+def start(name: str):
+    """
+    Starts recording the statements run on this thread
+    """
+    recording.stats = {'name': name, 'count': 0, 'seconds': 0.0, 'statements': Counter()}
+
+def stop() -> dict:
+    """
+    Stops recording on this thread and prints the number of statements, their time
+    and the statements that ran more than once, which usually point at an N+1
+
+    Returns:
+        dict: the recorded name, count, seconds and statement counts
+    """
+    stats = getattr(recording, 'stats', None)
+    recording.stats = None
+    if stats is None:
+        return None
+
+    print(f'{stats["name"]} ran {stats["count"]} statements in {stats["seconds"] * 1000:.1f}ms')
+    repeated = [(s, n) for s, n in stats['statements'].most_common(5) if n > 1]
+    for statement, count in repeated:
+        print(f'    {count}x {statement}')
+    budget = get_query_budget()
+    if budget and stats['count'] > budget:
+        print(f'{stats["name"]} exceeded its query budget of {budget}')
+    return stats
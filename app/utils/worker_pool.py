@@ -0,0 +1,22 @@
+"""Thread pool that keeps the order of tasks with the same key"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OrderedWorkerPool:
+    """
+    Runs tasks on a fixed number of single threaded lanes. Tasks with the same key always
+    run on the same lane, so messages for one eval are handled in the order they arrived
+    while messages for different evals are handled in parallel
+    """
+
+    def __init__(self, workers: int):
+        self.lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'results-{i}') for i in range(workers)]
+
+    def submit(self, key, fn, *args):
+        lane = self.lanes[hash(str(key)) % len(self.lanes)]
+        return lane.submit(fn, *args)
+
+    def shutdown(self, wait: bool = True):
+        for lane in self.lanes:
+            lane.shutdown(wait=wait)
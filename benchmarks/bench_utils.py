@@ -0,0 +1,307 @@
+"""Shared set up for the runner benchmarks
+
+The benchmarks import the runner from app/ and are run from the repo root, e.g.
+    python benchmarks/query_plans.py
+
+The ones that need postgres work in a scratch schema of the database at
+BENCH_POSTGRES_URL. The schema is dropped and created again on every run so they
+never touch the tables of a running deploy
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_DIR, 'app')
+sys.path.insert(0, APP_DIR)
+
+# the dicom file every synthetic instance is a copy of
+EXAMPLE_DICOM = os.path.join(REPO_DIR, 'example.dcm')
+
+# modalities of the synthetic studies, each gets an even share
+MODALITIES = ['CT', 'MR', 'CR', 'DX', 'US', 'MG', 'PT', 'NM', 'XA', 'RF']
+
+
+def timed(fn, repeat: int = 1):
+    """
+    Runs fn repeat times
+
+    Returns:
+        Tuple: the result of the last call and the mean seconds per call
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat
+
+def report(name: str, seconds: float, count: int = None):
+    """
+    Prints the time of one benchmark case and its throughput when a count is given
+    """
+    line = f'{name:<48} {seconds * 1000:10.1f}ms'
+    if count is not None and seconds > 0:
+        line += f' {count / seconds:14,.0f}/s'
+    print(line)
+
+def get_sequences(metadata):
+    """
+    Finds the sequences the backend migrations create for the id defaults
+    """
+    sequences = set()
+    for table in metadata.tables.values():
+        for column in table.columns:
+            if column.server_default is not None:
+                sequences.update(re.findall(r"nextval\('(\w+)'", str(column.server_default.arg)))
+    return sequences
+
+def init_scratch_db(schema: str = 'runner_bench'):
+    """
+    Creates an empty schema holding every table of models.py and points the runner's
+    connection pool at it
+
+    Args:
+        schema (str): the name of the scratch schema, dropped if it exists
+
+    Returns:
+        Engine: the runner's engine
+    """
+    url = os.getenv('BENCH_POSTGRES_URL')
+    if not url:
+        sys.exit('set BENCH_POSTGRES_URL to a database the benchmark may create a scratch schema in')
+
+    from sqlalchemy import create_engine, text
+    admin = create_engine(url)
+    with admin.begin() as conn:
+        conn.execute(text(f'DROP SCHEMA IF EXISTS {schema} CASCADE'))
+        conn.execute(text(f'CREATE SCHEMA {schema}'))
+    admin.dispose()
+
+    # every connection of the runner's pool resolves table names in the scratch schema
+    separator = '&' if '?' in url else '?'
+    os.environ['POSTGRES_URL'] = f'{url}{separator}options=-csearch_path%3D{schema}'
+
+    import db.models as models
+    from utils import db_utils
+    engine = create_engine(os.environ['POSTGRES_URL'])
+    with engine.begin() as conn:
+        for sequence in sorted(get_sequences(models.metadata)):
+            conn.execute(text(f'CREATE SEQUENCE {sequence}'))
+    models.metadata.create_all(engine)
+    engine.dispose()
+
+    db_utils.init_db()
+    return db_utils.db_engine
+
+def seed_studies(engine, count: int):
+    """
+    Inserts count series with a spread of modalities, added one second apart. Every
+    four series share a parent study and a third of them are deleted from orthanc
+
+    Returns:
+        int: the dateAdded of the newest series
+    """
+    from sqlalchemy import text
+    now = int(time.time())
+    with engine.begin() as conn:
+        conn.execute(text('''
+        INSERT INTO study ("orthancStudyId", "orthancParentId", "patientId", modality, type,
+                           description, "seriesMetadata", "studyMetadata", "deletedFromOrthanc", "dateAdded")
+        SELECT 'series-' || i, 'study-' || (i / 4), 'patient-' || (i / 40),
+               (CAST(:modalities AS varchar[]))[1 + i % :modality_count],
+               (CAST(:modalities AS varchar[]))[1 + i % :modality_count],
+               'series ' || i, '{"SeriesNumber": "1"}', '{"StudyDescription": "study"}',
+               i % 3 = 0, :now - i
+        FROM generate_series(0, :count - 1) AS i
+        '''), {'modalities': MODALITIES, 'modality_count': len(MODALITIES), 'now': now, 'count': count})
+    return now
+
+def seed_models(engine, count: int, running: bool = True):
+    """
+    Inserts count models, model i takes the modality MODALITIES[i % len], each with an
+    eval job
+
+    Returns:
+        List[int]: the model ids
+    """
+    from sqlalchemy import text
+    with engine.begin() as conn:
+        rows = conn.execute(text('''
+        INSERT INTO model (image, "displayName", input, modality, output, "hasImageOutput")
+        SELECT 'image-' || i, 'model ' || i, (CAST(:modalities AS varchar[]))[1 + i % :modality_count],
+               (CAST(:modalities AS varchar[]))[1 + i % :modality_count], 'json', false
+        FROM generate_series(0, :count - 1) AS i
+        RETURNING id
+        '''), {'modalities': MODALITIES, 'modality_count': len(MODALITIES), 'count': count}).all()
+        model_ids = sorted(r.id for r in rows)
+        conn.execute(text('''
+        INSERT INTO eval_job (running, "modelId") SELECT :running, unnest(CAST(:model_ids AS integer[]))
+        '''), {'running': running, 'model_ids': model_ids})
+    return model_ids
+
+def analyze(engine):
+    from sqlalchemy import text
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text('ANALYZE'))
+
+def get_peak_rss() -> int:
+    """
+    Gets the peak resident memory of this process in bytes
+    """
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def use_settings(**env):
+    """
+    Sets environment settings and pins the app settings snapshot to the environment
+    defaults so no settings row is read from postgres
+    """
+    os.environ.update({key: str(value) for key, value in env.items()})
+    os.environ['SETTINGS_CHECK_INTERVAL'] = str(10 ** 9)
+    from types import MappingProxyType
+    from services import settings_service
+    settings_service.snapshot = MappingProxyType(settings_service.get_default_settings())
+    settings_service.last_check = time.monotonic()
+
+def make_orthanc_id(kind: str, i: int) -> str:
+    digest = hashlib.sha1(f'{kind}-{i}'.encode()).hexdigest()
+    return '-'.join(digest[j:j + 8] for j in range(0, 40, 8))
+
+
+class FakeOrthanc:
+    """
+    A local http server answering the orthanc endpoints the runner uses: /series,
+    /series/{id}, /series/{id}/archive, /instances/{id}/file and /changes. Every
+    instance is a copy of example.dcm. latency seconds are slept before each response
+    to stand in for the network and orthanc's own work, and bandwidth limits the bytes
+    per second each connection sends if it is set
+
+        with FakeOrthanc(series=1000, instances=10, latency=0.005) as orthanc:
+            use_settings(ORTHANC_URL=orthanc.url)
+    """
+
+    def __init__(self, series: int = 0, instances: int = 1, latency: float = 0.0, bandwidth: int = None):
+        with open(EXAMPLE_DICOM, 'rb') as dicom:
+            self.dicom = dicom.read()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.series = {}
+        self.changes = []
+        self.archives = {}
+        self.lock = threading.Lock()
+        self.add_series(series, instances)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def add_series(self, count: int, instances: int = 1):
+        """
+        Adds series to the archive and logs the changes orthanc would: a NewInstance
+        per instance then NewSeries and, later, StableSeries
+        """
+        with self.lock:
+            start = len(self.series)
+            for i in range(start, start + count):
+                series_id = make_orthanc_id('series', i)
+                instance_ids = [make_orthanc_id(f'instance-{i}', j) for j in range(instances)]
+                self.series[series_id] = instance_ids
+                for instance_id in instance_ids:
+                    self.log_change('NewInstance', instance_id, 'Instance')
+                self.log_change('NewSeries', series_id, 'Series')
+            for series_id in list(self.series)[start:]:
+                self.log_change('StableSeries', series_id, 'Series')
+
+    def log_change(self, change_type: str, resource_id: str, resource_type: str):
+        self.changes.append({'ChangeType': change_type, 'ID': resource_id, 'ResourceType': resource_type,
+                             'Seq': len(self.changes) + 1})
+
+    def get_archive(self, series_id: str) -> bytes:
+        with self.lock:
+            if series_id not in self.archives:
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                    for instance_id in self.series[series_id]:
+                        archive.writestr(f'{instance_id}.dcm', self.dicom)
+                self.archives[series_id] = buffer.getvalue()
+            return self.archives[series_id]
+
+    def get_changes(self, since: int, limit: int) -> dict:
+        # sequence numbers start at 1 and are contiguous
+        page = self.changes[since:since + limit]
+        last = page[-1]['Seq'] if page else since
+        return {'Changes': page, 'Done': last >= len(self.changes), 'Last': last}
+
+    def make_handler(self):
+        orthanc = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, without this every keep-alive
+            # response waits for the client's delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if orthanc.bandwidth is None:
+                    self.wfile.write(body)
+                    return
+                chunk_size = 64 * 1024
+                for i in range(0, len(body), chunk_size):
+                    self.wfile.write(body[i:i + chunk_size])
+                    time.sleep(chunk_size / orthanc.bandwidth)
+
+            def send_json(self, value):
+                self.send_body(json.dumps(value).encode(), 'application/json')
+
+            def do_GET(self):
+                if orthanc.latency:
+                    time.sleep(orthanc.latency)
+                url = urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                if parts == ['series']:
+                    return self.send_json(list(orthanc.series))
+                if parts == ['changes']:
+                    query = parse_qs(url.query)
+                    return self.send_json(orthanc.get_changes(int(query.get('since', ['0'])[0]),
+                                                              int(query.get('limit', ['100'])[0])))
+                if len(parts) >= 2 and parts[0] == 'series' and parts[1] in orthanc.series:
+                    if len(parts) == 2:
+                        return self.send_json({'ID': parts[1], 'Instances': orthanc.series[parts[1]],
+                                               'ParentStudy': make_orthanc_id('study', 0),
+                                               'MainDicomTags': {'Modality': 'CT'}})
+                    if parts[2:] == ['archive']:
+                        return self.send_body(orthanc.get_archive(parts[1]), 'application/zip')
+                if len(parts) == 3 and parts[0] == 'instances' and parts[2] == 'file':
+                    return self.send_body(orthanc.dicom, 'application/dicom')
+                self.send_error(404)
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,55 @@
+"""Benchmark of the 'archive' and 'instances' download modes
+
+A local fake orthanc serves a series of copies of example.dcm with a fixed latency
+per request and a bandwidth limit per connection, which stand in for the round trip
+to orthanc and the speed of one TCP stream. Times orthanc_service.download_study_dicom
+in 'archive' mode, one request for the whole series, and in 'instances' mode at a
+range of ORTHANC_DOWNLOAD_CONCURRENCY values. No database is needed
+
+    python benchmarks/download_modes.py --instances 200 --latency 0.01 --bandwidth 50000000
+"""
+
+import argparse
+import shutil
+import tempfile
+
+from bench_utils import FakeOrthanc, report, timed, use_settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, default=200, help='the number of instances in the series')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds orthanc takes per request')
+    parser.add_argument('--bandwidth', type=int, default=50 * 10 ** 6, help='bytes per second per connection')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # study_db and orthanc_service import each other, study_db has to be loaded first
+    from db import study_db
+    from services import orthanc_service
+    images_dir = tempfile.mkdtemp(prefix='runner-bench-')
+    orthanc_service.IMAGES_DIR = images_dir
+
+    with FakeOrthanc(series=1, instances=args.instances, latency=args.latency, bandwidth=args.bandwidth) as orthanc:
+        orthanc_id = next(iter(orthanc.series))
+        instance_ids = orthanc.series[orthanc_id]
+        size = len(orthanc.dicom) * args.instances
+        print(f'series of {args.instances} instances, {size / 2 ** 20:.0f}MiB')
+
+        cases = [('archive', {'ORTHANC_DOWNLOAD_MODE': 'archive'})]
+        cases += [(f'instances, concurrency {c}', {'ORTHANC_DOWNLOAD_MODE': 'instances', 'ORTHANC_DOWNLOAD_CONCURRENCY': c})
+                  for c in args.concurrency]
+        try:
+            for name, env in cases:
+                use_settings(ORTHANC_URL=orthanc.url, **env)
+                # the pool is sized from the download concurrency when the client is made
+                orthanc_service.reset_clients({'orthancUrl': None}, {'orthancUrl': orthanc.url})
+                _, seconds = timed(lambda: orthanc_service.download_study_dicom(orthanc_id, instance_ids), args.repeat)
+                report(f'{name} (bytes)', seconds, size)
+        finally:
+            shutil.rmtree(images_dir, ignore_errors=True)
+            orthanc_service.get_client().close()
+
+if __name__ == '__main__':
+    main()
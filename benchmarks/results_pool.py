@@ -0,0 +1,70 @@
+"""Load test of the ordered worker pool the results processor consumes with
+
+Submits a START, LOG and COMPLETE message for each of a number of evals to an
+OrderedWorkerPool keyed by eval id, the way make_consumer does, at a fixed arrival
+rate. Each handler sleeps for the time a database write takes. Reports messages per
+second and the p50 and p99 latency from arrival to handled for a range of lane
+counts, 1 lane being the single threaded consumer. Fails if any eval's messages
+were handled out of order. No database or broker is needed
+
+    python benchmarks/results_pool.py --evals 2000 --work 0.002 --rate 2000
+"""
+
+import argparse
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from bench_utils import percentile
+
+from utils.worker_pool import OrderedWorkerPool
+
+MESSAGE_TYPES = ['START', 'LOG', 'COMPLETE']
+
+
+def run(workers: int, evals: int, work: float, rate: float):
+    pool = OrderedWorkerPool(workers)
+    latencies = []
+    handled = defaultdict(list)
+    lock = threading.Lock()
+
+    def handle(eval_id: int, msg_type: str, arrived: float):
+        time.sleep(work)
+        with lock:
+            handled[eval_id].append(msg_type)
+            latencies.append(time.perf_counter() - arrived)
+
+    # messages of an eval arrive spread out among the messages of other evals
+    messages = [(eval_id, msg_type) for msg_type in MESSAGE_TYPES for eval_id in range(evals)]
+    start = time.perf_counter()
+    for i, (eval_id, msg_type) in enumerate(messages):
+        delay = start + i / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(eval_id, handle, eval_id, msg_type, time.perf_counter())
+    pool.shutdown(wait=True)
+    seconds = time.perf_counter() - start
+
+    in_order = all(types == MESSAGE_TYPES for types in handled.values())
+    return len(messages) / seconds, percentile(latencies, 0.5), percentile(latencies, 0.99), in_order
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--evals', type=int, default=2000)
+    parser.add_argument('--work', type=float, default=0.002, help='seconds a handler takes')
+    parser.add_argument('--rate', type=float, default=2000, help='messages arriving per second')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    ordered = True
+    for workers in args.workers:
+        throughput, p50, p99, in_order = run(workers, args.evals, args.work, args.rate)
+        ordered = ordered and in_order
+        print(f'{workers:>3} lanes {throughput:10,.0f} msg/s  p50 {p50 * 1000:9.1f}ms  p99 {p99 * 1000:9.1f}ms'
+              f'{"" if in_order else "  OUT OF ORDER"}')
+    if not ordered:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Benchmark of matching studies against the compiled routing table
+
+Compiles the criteria of synthetic models into a routing_service.RoutingTable: a
+third take a whole modality, a third a list of study types, and the rest add a
+description pattern or a DICOM tag predicate. Then routes synthetic studies in
+batches the way route_studies does. Compares the table, which only checks the
+routes of a study's modality, with checking every model's criteria per study.
+Also times recompiling the table when one model changed against compiling all of
+them. No database is needed
+
+    python benchmarks/routing.py --models 100 --studies 1000000
+"""
+
+import argparse
+import json
+from typing import NamedTuple
+
+from bench_utils import MODALITIES, report, timed
+
+from services.routing_service import RoutingTable, StudyFacts
+
+BODY_PARTS = ['CHEST', 'HEAD', 'ABDOMEN', 'KNEE', 'SPINE']
+
+
+class ModelRow(NamedTuple):
+    id: int
+    modality: str
+    input: str
+    inputType: str
+
+
+def make_models(count: int):
+    models = []
+    for i in range(count):
+        modality = MODALITIES[i % len(MODALITIES)]
+        kind = i % 6
+        if kind < 2:
+            model_input = modality
+        elif kind < 4:
+            model_input = json.dumps({'types': [modality, f'{modality}_LOCALIZER']})
+        elif kind == 4:
+            model_input = json.dumps({'types': modality, 'description': 'contrast|angio'})
+        else:
+            model_input = json.dumps({'tags': {'BodyPartExamined': BODY_PARTS[i % len(BODY_PARTS)]}})
+        models.append(ModelRow(i + 1, modality, model_input, 'study'))
+    return models
+
+def make_batch(start: int, size: int):
+    return [StudyFacts(f'series-{i}', MODALITIES[i % len(MODALITIES)], MODALITIES[i % len(MODALITIES)],
+                       'with contrast' if i % 7 == 0 else 'plain',
+                       {'BodyPartExamined': BODY_PARTS[i % len(BODY_PARTS)], 'SeriesNumber': str(i % 9)})
+            for i in range(start, start + size)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', type=int, default=100)
+    parser.add_argument('--studies', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=1000, help='studies per route_studies call')
+    args = parser.parse_args()
+
+    models = make_models(args.models)
+    table = RoutingTable()
+    _, seconds = timed(lambda: table.update(models))
+    report(f'compile {args.models} models', seconds)
+
+    changed = list(models)
+    changed[0] = changed[0]._replace(input=json.dumps({'description': 'contrast'}))
+    _, seconds = timed(lambda: table.update(changed))
+    report('recompile after one model changed', seconds)
+    _, seconds = timed(lambda: table.update(models), 100)
+    report('refresh with nothing changed', seconds)
+
+    routes = list(table.routes.values())
+
+    def route_all(match):
+        matched = 0
+        for start in range(0, args.studies, args.batch_size):
+            for facts in make_batch(start, min(args.batch_size, args.studies - start)):
+                matched += len(match(facts))
+        return matched
+
+    # building the studies is part of both runs, time it to take it out
+    _, build_seconds = timed(lambda: route_all(lambda facts: ()))
+    matched, seconds = timed(lambda: route_all(table.match))
+    report(f'routing table, {matched} routes', seconds - build_seconds, args.studies)
+
+    def match_every_model(facts):
+        return [r.model_id for r in routes if r.modality == facts.modality and r.matches(facts)]
+
+    matched, seconds = timed(lambda: route_all(match_every_model))
+    report(f'every model per study, {matched} routes', seconds - build_seconds, args.studies)
+
+if __name__ == '__main__':
+    main()
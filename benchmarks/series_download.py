@@ -0,0 +1,78 @@
+"""Memory and throughput benchmark of downloading a series archive
+
+A local fake orthanc serves a series of copies of example.dcm as one zip archive.
+The archive is downloaded and extracted by orthanc_service.download_series_archive,
+which streams it to disk, and by the previous implementation, which held the whole
+response in memory before writing it out. Reports the throughput of each and the
+peak python memory of one download, traced separately so tracing does not slow the
+timed runs. No database is needed
+
+    python benchmarks/series_download.py --instances 400
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import tracemalloc
+from zipfile import ZipFile
+
+import requests
+
+from bench_utils import FakeOrthanc, report, timed, use_settings
+
+
+def download_in_memory(url: str, images_dir: str, orthanc_id: str):
+    # the download before streaming: the response body is read into memory at once
+    study = requests.get(f'{url}/series/{orthanc_id}/archive')
+    zip_path = f'{images_dir}/{orthanc_id}.zip'
+    with open(zip_path, 'wb') as zip_file:
+        zip_file.write(study.content)
+    with ZipFile(zip_path, 'r') as zip_obj:
+        zip_obj.extractall(f'{images_dir}/{orthanc_id}')
+    os.remove(zip_path)
+
+def traced_peak(fn) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, default=200, help='the number of instances in the series')
+    parser.add_argument('--chunk-bytes', type=int, default=1024 * 1024, help='ORTHANC_DOWNLOAD_CHUNK_BYTES')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # study_db and orthanc_service import each other, study_db has to be loaded first
+    from db import study_db
+    from services import orthanc_service
+    images_dir = tempfile.mkdtemp(prefix='runner-bench-')
+    orthanc_service.IMAGES_DIR = images_dir
+
+    with FakeOrthanc(series=1, instances=args.instances) as orthanc:
+        use_settings(ORTHANC_URL=orthanc.url, ORTHANC_DOWNLOAD_CHUNK_BYTES=args.chunk_bytes)
+        orthanc_id = next(iter(orthanc.series))
+        size = len(orthanc.get_archive(orthanc_id))
+        print(f'series of {args.instances} instances, {size / 2 ** 20:.0f}MiB archive')
+
+        cases = [
+            ('in memory', lambda: download_in_memory(orthanc.url, images_dir, orthanc_id)),
+            ('streamed', lambda: orthanc_service.download_series_archive(orthanc_id)),
+        ]
+        try:
+            for name, download in cases:
+                _, seconds = timed(download, args.repeat)
+                report(f'{name} throughput (bytes)', seconds, size)
+                peak = traced_peak(download)
+                print(f'{name + " peak python memory":<48} {peak / 2 ** 20:10.1f}MiB')
+                shutil.rmtree(f'{images_dir}/{orthanc_id}', ignore_errors=True)
+        finally:
+            shutil.rmtree(images_dir, ignore_errors=True)
+            orthanc_service.get_client().close()
+
+if __name__ == '__main__':
+    main()
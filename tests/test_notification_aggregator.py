@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+from services import messaging_service
+from services.messaging_service import NOTIFICATION_QUEUE, NotificationAggregator
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Records the notifications the aggregator sends as (user id, message dict)
+    """
+    sent = []
+
+    def send_messages(queue, messages, user_id=-1):
+        assert queue == NOTIFICATION_QUEUE
+        sent.extend((user_id, message) for message in messages)
+        return True
+
+    monkeypatch.setattr(messaging_service, 'send_messages', send_messages)
+    return sent
+
+@pytest.fixture
+def aggregator():
+    # a long window so only the test flushes
+    aggregator = NotificationAggregator(60, ['experiment_finished'])
+    yield aggregator
+    aggregator.stopped.set()
+
+def test_a_single_notification_is_sent_unchanged(sent, aggregator):
+    aggregator.add(['Finished evaluation 7'], 'new_result', -1)
+    aggregator.flush()
+
+    assert sent == [(-1, {'message': 'Finished evaluation 7', 'type': 'new_result', 'count': 1})]
+
+def test_notifications_of_a_type_are_summarized(sent, aggregator):
+    aggregator.add(['Started evaluation of study 1', 'Started evaluation of study 2'], 'eval_started', -1,
+                   group='model X')
+    aggregator.add(['Started evaluation of study 3'], 'eval_started', -1, group='model X')
+    assert sent == []
+
+    aggregator.flush()
+
+    assert sent == [(-1, {'message': 'Started 3 evaluations for model X', 'type': 'eval_started', 'count': 3})]
+
+def test_buffers_are_kept_per_type_user_and_group(sent, aggregator):
+    aggregator.add(['Study a ready', 'Study b ready'], 'study_ready', -1)
+    aggregator.add(['Finished evaluation 1', 'Finished evaluation 2'], 'new_result', -1)
+    aggregator.add(['Finished evaluation 3', 'Finished evaluation 4'], 'new_result', 5)
+    aggregator.add(['failed', 'failed'], 'eval_failed', -1, group='model X')
+    aggregator.add(['failed', 'failed'], 'eval_failed', -1, group='model Y')
+    aggregator.flush()
+
+    assert sorted((user_id, message['message']) for user_id, message in sent) == [
+        (-1, '2 evaluations failed for model X'),
+        (-1, '2 evaluations failed for model Y'),
+        (-1, '2 studies ready'),
+        (-1, 'Finished 2 evaluations'),
+        (5, 'Finished 2 evaluations'),
+    ]
+
+def test_unknown_types_get_a_generic_summary(sent, aggregator):
+    aggregator.add(['one', 'two'], 'something_else', -1)
+    aggregator.flush()
+
+    assert sent[0][1]['message'] == '2 notifications'
+
+def test_immediate_types_skip_the_buffer(sent, aggregator):
+    aggregator.add(['Completed experiment A', 'Completed experiment B'], 'experiment_finished', 3)
+
+    assert sent == [(3, {'message': 'Completed experiment A', 'type': 'experiment_finished'}),
+                    (3, {'message': 'Completed experiment B', 'type': 'experiment_finished'})]
+    assert aggregator.pending == {}
+
+def test_a_zero_window_sends_immediately(sent):
+    aggregator = NotificationAggregator(0, [])
+    aggregator.add(['Study a ready'], 'study_ready', -1)
+
+    assert sent == [(-1, {'message': 'Study a ready', 'type': 'study_ready'})]
+    assert aggregator.thread is None
+
+def test_flushing_empties_the_buffers(sent, aggregator):
+    aggregator.add(['Study a ready'], 'study_ready', -1)
+    aggregator.flush()
+    aggregator.flush()
+
+    assert len(sent) == 1
+
+def test_stop_flushes_what_is_pending(sent, aggregator):
+    aggregator.add(['Study a ready', 'Study b ready'], 'study_ready', -1)
+    aggregator.stop()
+
+    assert sent == [(-1, {'message': '2 studies ready', 'type': 'study_ready', 'count': 2})]
+
+def test_the_window_flushes_in_the_background(sent):
+    aggregator = NotificationAggregator(0.05, [])
+    aggregator.add(['Study a ready', 'Study b ready'], 'study_ready', -1)
+
+    deadline = time.monotonic() + 2
+    while len(sent) == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    aggregator.stopped.set()
+
+    assert sent == [(-1, {'message': '2 studies ready', 'type': 'study_ready', 'count': 2})]
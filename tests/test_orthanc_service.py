@@ -0,0 +1,75 @@
+# study_db and orthanc_service import each other, study_db has to be loaded first
+from db import study_db
+from services import orthanc_service
+
+
+def make_change(seq, change_type, resource_id):
+    return {'Seq': seq, 'ChangeType': change_type, 'ID': resource_id}
+
+def serve_changes(monkeypatch, changes):
+    """
+    Answers get_changes from a list of changes the way orthanc pages its change log
+    and records the since of every request
+    """
+    requests = []
+
+    def get_changes(since, limit):
+        requests.append(since)
+        page = [c for c in changes if c['Seq'] > since][:limit]
+        last = page[-1]['Seq'] if page else since
+        return {'Changes': page, 'Done': last >= changes[-1]['Seq'] if changes else True, 'Last': last}
+
+    monkeypatch.setattr(orthanc_service, 'get_changes', get_changes)
+    return requests
+
+def test_reads_every_page(monkeypatch):
+    changes = [make_change(i, 'NewSeries', f'series-{i}') for i in range(1, 8)]
+    requests = serve_changes(monkeypatch, changes)
+
+    series_ids, last_seq = orthanc_service.get_new_series_ids(0, 100, page_size=3)
+
+    assert series_ids == [f'series-{i}' for i in range(1, 8)]
+    assert last_seq == 7
+    assert requests == [0, 3, 6]
+
+def test_skips_other_changes_and_repeated_series(monkeypatch):
+    changes = [
+        make_change(1, 'NewInstance', 'instance-1'),
+        make_change(2, 'NewSeries', 'series-1'),
+        make_change(3, 'NewPatient', 'patient-1'),
+        make_change(4, 'StableSeries', 'series-1'),
+        make_change(5, 'StableSeries', 'series-2'),
+    ]
+    serve_changes(monkeypatch, changes)
+
+    series_ids, last_seq = orthanc_service.get_new_series_ids(0, 100, page_size=2)
+
+    assert series_ids == ['series-1', 'series-2']
+    assert last_seq == 5
+
+def test_stops_at_the_last_returned_series(monkeypatch):
+    changes = [make_change(i, 'NewSeries', f'series-{i}') for i in range(1, 11)]
+    serve_changes(monkeypatch, changes)
+
+    series_ids, last_seq = orthanc_service.get_new_series_ids(0, 4, page_size=3)
+
+    # resuming from last_seq must not skip series-5
+    assert series_ids == ['series-1', 'series-2', 'series-3', 'series-4']
+    assert last_seq == 4
+    assert orthanc_service.get_new_series_ids(last_seq, 100, page_size=3)[0] == \
+        [f'series-{i}' for i in range(5, 11)]
+
+def test_resumes_after_since(monkeypatch):
+    changes = [make_change(i, 'NewSeries', f'series-{i}') for i in range(1, 6)]
+    requests = serve_changes(monkeypatch, changes)
+
+    series_ids, last_seq = orthanc_service.get_new_series_ids(3, 100)
+
+    assert series_ids == ['series-4', 'series-5']
+    assert last_seq == 5
+    assert requests == [3]
+
+def test_empty_log_keeps_the_cursor(monkeypatch):
+    serve_changes(monkeypatch, [])
+
+    assert orthanc_service.get_new_series_ids(42, 100) == ([], 42)
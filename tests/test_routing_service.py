@@ -0,0 +1,111 @@
+import json
+import re
+from typing import NamedTuple
+
+import pytest
+
+from services.routing_service import Route, RoutingTable, StudyFacts, parse_criteria
+
+
+class ModelRow(NamedTuple):
+    id: int
+    modality: str
+    input: str
+    inputType: str = 'study'
+
+
+def make_facts(modality='CT', study_type='CT', description='', tags=None):
+    return StudyFacts('series-1', modality, study_type, description, tags or {})
+
+def test_a_plain_study_type_matches_every_study():
+    route = Route(1, 'CT', 'CT')
+
+    assert route.matches(make_facts())
+    assert route.matches(make_facts(study_type='CT_LOCALIZER', description='anything'))
+
+def test_types_match_one_or_a_list():
+    assert Route(1, 'CT', json.dumps({'types': 'CT'})).matches(make_facts())
+    assert not Route(1, 'CT', json.dumps({'types': 'CT'})).matches(make_facts(study_type='CT_LOCALIZER'))
+
+    route = Route(1, 'CT', json.dumps({'types': ['CT', 'CT_LOCALIZER']}))
+    assert route.matches(make_facts(study_type='CT_LOCALIZER'))
+    assert not route.matches(make_facts(study_type='MR'))
+
+def test_description_is_searched_case_insensitively():
+    route = Route(1, 'CT', json.dumps({'description': 'contrast|angio'}))
+
+    assert route.matches(make_facts(description='Chest WITH CONTRAST'))
+    assert route.matches(make_facts(description='cta angio run'))
+    assert not route.matches(make_facts(description='plain chest'))
+    assert not route.matches(make_facts(description=None))
+
+def test_tags_must_match_fully():
+    route = Route(1, 'CT', json.dumps({'tags': {'BodyPartExamined': 'CHEST|ABDOMEN', 'SliceThickness': '[0-2]'}}))
+
+    assert route.matches(make_facts(tags={'BodyPartExamined': 'CHEST', 'SliceThickness': 1}))
+    # values are matched against the whole tag and as strings
+    assert not route.matches(make_facts(tags={'BodyPartExamined': 'CHEST WALL', 'SliceThickness': 1}))
+    assert not route.matches(make_facts(tags={'BodyPartExamined': 'CHEST', 'SliceThickness': 5}))
+    # a missing tag never matches
+    assert not route.matches(make_facts(tags={'BodyPartExamined': 'CHEST'}))
+
+def test_every_criterion_must_match():
+    route = Route(1, 'CT', json.dumps({'types': 'CT', 'description': 'contrast',
+                                       'tags': {'BodyPartExamined': 'CHEST'}}))
+    facts = make_facts(description='contrast', tags={'BodyPartExamined': 'CHEST'})
+
+    assert route.matches(facts)
+    assert not route.matches(facts._replace(type='MR'))
+    assert not route.matches(facts._replace(description='plain'))
+    assert not route.matches(facts._replace(tags={'BodyPartExamined': 'HEAD'}))
+
+@pytest.mark.parametrize('model_input', ['{"tags": ["BodyPartExamined"]}', '{"description": "("}',
+                                         '{"types": 5}', '{"types": '])
+def test_malformed_criteria_do_not_compile(model_input):
+    with pytest.raises((re.error, AttributeError, TypeError, ValueError)):
+        Route(1, 'CT', model_input)
+
+def test_plain_inputs_have_no_criteria():
+    assert parse_criteria('CT') == {}
+    assert parse_criteria(None) == {}
+    assert parse_criteria('["CT"]') == {}
+
+def test_the_table_only_matches_routes_of_the_study_modality():
+    table = RoutingTable()
+    table.update([ModelRow(1, 'CT', 'CT'), ModelRow(2, 'MR', 'MR'),
+                  ModelRow(3, 'CT', json.dumps({'description': 'contrast'}))])
+
+    assert sorted(table.match(make_facts(description='contrast'))) == [1, 3]
+    assert table.match(make_facts(modality='MR', study_type='MR')) == [2]
+    assert table.match(make_facts(modality='US', study_type='US')) == []
+
+def test_the_table_skips_models_with_malformed_criteria():
+    table = RoutingTable()
+    table.update([ModelRow(1, 'CT', 'CT'), ModelRow(2, 'CT', '{"tags": ["oops"]}')])
+
+    assert table.match(make_facts()) == [1]
+    assert 2 not in table.routes
+
+    # fixing the criteria compiles the route
+    table.update([ModelRow(1, 'CT', 'CT'), ModelRow(2, 'CT', json.dumps({'types': 'CT'}))])
+    assert sorted(table.match(make_facts())) == [1, 2]
+
+def test_the_table_recompiles_only_changed_models():
+    table = RoutingTable()
+    table.update([ModelRow(1, 'CT', 'CT'), ModelRow(2, 'CT', 'CT')])
+    first, second = table.routes[1], table.routes[2]
+
+    table.update([ModelRow(1, 'CT', 'CT'), ModelRow(2, 'CT', json.dumps({'types': 'CT_LOCALIZER'}))])
+
+    assert table.routes[1] is first
+    assert table.routes[2] is not second
+    assert table.match(make_facts()) == [1]
+
+def test_removed_models_are_dropped():
+    table = RoutingTable()
+    table.update([ModelRow(1, 'CT', 'CT'), ModelRow(2, 'CT', '{"types": ')])
+    table.update([ModelRow(3, 'MR', 'MR')])
+
+    assert set(table.routes) == {3}
+    assert set(table.signatures) == {3}
+    assert table.match(make_facts()) == []
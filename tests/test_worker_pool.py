@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+
+from utils.worker_pool import OrderedWorkerPool
+
+
+def keys_on_different_lanes(pool: OrderedWorkerPool):
+    lanes = {}
+    for key in range(100):
+        # the lane submit picks for the key
+        lanes.setdefault(hash(str(key)) % len(pool.lanes), key)
+        if len(lanes) == 2:
+            return list(lanes.values())
+    raise AssertionError('every key hashed to one lane')
+
+def test_tasks_with_the_same_key_run_in_order():
+    pool = OrderedWorkerPool(4)
+    handled = {key: [] for key in range(10)}
+
+    def handle(key, i):
+        time.sleep(random.random() / 1000)
+        handled[key].append(i)
+
+    for i in range(50):
+        for key in handled:
+            pool.submit(key, handle, key, i)
+    pool.shutdown(wait=True)
+
+    assert all(order == list(range(50)) for order in handled.values())
+
+def test_tasks_with_the_same_key_run_one_at_a_time():
+    pool = OrderedWorkerPool(4)
+    running = []
+    overlapped = []
+
+    def handle():
+        running.append(1)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.001)
+        running.pop()
+
+    for _ in range(20):
+        pool.submit('eval-1', handle)
+    pool.shutdown(wait=True)
+
+    assert not any(overlapped)
+
+def test_a_blocked_key_does_not_hold_up_other_lanes():
+    pool = OrderedWorkerPool(2)
+    blocked_key, other_key = keys_on_different_lanes(pool)
+    release = threading.Event()
+
+    blocked = pool.submit(blocked_key, release.wait, 5)
+    other = pool.submit(other_key, lambda: 'done')
+
+    assert other.result(timeout=1) == 'done'
+    assert not blocked.done()
+    release.set()
+    assert blocked.result(timeout=1) is True
+    pool.shutdown()
+
+def test_submit_returns_the_result_and_errors_of_the_task():
+    pool = OrderedWorkerPool(2)
+
+    def fail():
+        raise ValueError('bad message')
+
+    assert pool.submit(1, lambda a, b: a + b, 2, 3).result(timeout=1) == 5
+    failed = pool.submit(1, fail)
+    assert isinstance(failed.exception(timeout=1), ValueError)
+    # a failed task does not stop its lane
+    assert pool.submit(1, lambda: 'next').result(timeout=1) == 'next'
+    pool.shutdown()
+
+def test_shutdown_waits_for_queued_tasks():
+    pool = OrderedWorkerPool(2)
+    handled = []
+    for i in range(20):
+        pool.submit(i % 3, lambda i=i: (time.sleep(0.001), handled.append(i)))
+    pool.shutdown(wait=True)
+
+    assert sorted(handled) == list(range(20))